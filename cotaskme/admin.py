@@ -1,6 +1,7 @@
 from django.contrib import admin
-from cotaskme.models import TaskList, Task, TaskEvent
+from cotaskme.models import TaskList, Task, TaskEvent, TaskEventSummary
 
 admin.site.register(TaskList)
 admin.site.register(Task)
 admin.site.register(TaskEvent)
+admin.site.register(TaskEventSummary)
@@ -0,0 +1,9 @@
+# The admin's URLconf. urls.py includes it lazily, so that
+# admin.autodiscover(), which imports every app's admin module, runs the
+# first time an admin page is requested or reversed rather than when the
+# site loads.
+
+from django.contrib import admin
+admin.autodiscover()
+
+urlpatterns = admin.site.get_urls()
@@ -0,0 +1,98 @@
+"""Caching of rendered task rows and TaskList display titles.
+
+Cached values are keyed on a generation number for each TaskList they
+depend on. The generation is bumped by signal handlers (connected in
+models.py) whenever a TaskList is saved or deleted or its owners, posters,
+or observers change, which orphans every cached value that depended on
+the old generation. Task rows also include the task's modified time in
+their key, so saving a Task invalidates its rows.
+
+Generations are stored in the database (TaskListGeneration), not in the
+cache, so a change made by one server process orphans the values cached
+by all of them, whatever the cache backend. A per-process cache is
+correct, just less effective than a shared one.
+
+Nothing that decides permissions is cached here (see TaskListRoles)."""
+
+from django.core.cache import cache
+
+ROW_TIMEOUT = 60*60*24 # one day
+
+def get_generations(ids):
+    """Returns a dict mapping TaskList ids to their current generation."""
+    from cotaskme.models import TaskListGeneration
+    return TaskListGeneration.get(ids)
+
+def bump_generations(ids):
+    """Invalidates all cached values that depend on the given TaskLists.
+
+    The pages of the lists that share tasks with them show their titles,
+    so those lists are touched too, which changes the pages' ETags (see
+    views.get_tasklist_validators). Generations are bumped rarely, so this
+    keeps the cost off of the far more frequent page loads."""
+    from cotaskme.models import TaskList, TaskListGeneration, Task
+    ids = set(ids)
+    if not ids: return
+    TaskListGeneration.bump(ids)
+    neighbors = set(Task.objects.filter(incoming__in=ids).exclude(outgoing=None).order_by().values_list("outgoing", flat=True).distinct())
+    neighbors |= set(Task.objects.filter(outgoing__in=ids).order_by().values_list("incoming", flat=True).distinct())
+    TaskList.touch(ids | neighbors)
+
+def get_titles_for_assigned_to(tasklists, gens):
+    """Returns a dict from TaskList id to cached title_for_assigned_to
+    values, for those that are cached, given the lists' generations."""
+    keys = dict(("cotaskme:tl-title:%d:%d" % (tl.id, gens[tl.id]), tl.id) for tl in tasklists)
+    return dict((keys[k], v) for k, v in cache.get_many(keys.keys()).items())
+
+def set_titles_for_assigned_to(titles, gens):
+    """Caches title_for_assigned_to values given a dict from TaskList id
+    and the generations they were computed at."""
+    cache.set_many(dict(("cotaskme:tl-title:%d:%d" % (id, gens[id]), title) for id, title in titles.items()), ROW_TIMEOUT)
+
+def get_task_row_keys(tasks, user, which_way):
+    """Returns a dict from Task id to the cache key for the task's rendered
+    row as seen by user. The row depends on the task itself, on the incoming
+    and outgoing lists (their titles and the user's roles on them), on
+    whether the user created the task, and on the view orientation."""
+    from cotaskme.models import TaskListRoles
+    roles = TaskListRoles.for_user(user)
+    gens = get_generations([t.incoming_id for t in tasks] + [t.outgoing_id for t in tasks if t.outgoing_id])
+    ret = { }
+    for t in tasks:
+        viewer = "%d%d%d" % (
+            "admin" in roles.get_roles(t.incoming),
+            t.outgoing_id is not None and "admin" in roles.get_roles(t.outgoing),
+            user.is_authenticated() and t.creator_id == user.id)
+        ret[t.id] = "cotaskme:task-row:%d:%s:%d:%d:%s:%s" % (
+            t.id, t.modified.isoformat(),
+            gens[t.incoming_id], gens.get(t.outgoing_id, 0),
+            viewer, which_way)
+    return ret
+
+# Signal handlers.
+
+def tasklist_changed(sender, instance, **kwargs):
+    bump_generations([instance.id])
+
+def tasklist_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # The owners, posters, or observers of TaskLists changed.
+    if action not in ("post_add", "post_remove", "pre_clear"): return
+    from cotaskme.models import TaskList
+    relation = [f for f in ("owners", "posters", "observers") if getattr(TaskList, f).through is sender][0]
+
+    if not reverse:
+        # instance is a TaskList and pk_set holds User ids
+        tasklist_ids = set([instance.id])
+        user_ids = pk_set if action != "pre_clear" else getattr(instance, relation).values_list("id", flat=True)
+    else:
+        # instance is a User and pk_set holds TaskList ids
+        tasklist_ids = pk_set if action != "pre_clear" else TaskList.objects.filter(**{ relation: instance }).values_list("id", flat=True)
+        tasklist_ids = set(tasklist_ids)
+        user_ids = [instance.id]
+
+    if relation == "owners":
+        # The display title of a list depends on how many lists its owner
+        # has, so every list owned by an affected user is affected.
+        tasklist_ids |= set(TaskList.owners.through.objects.filter(user__in=user_ids).values_list("tasklist_id", flat=True))
+
+    bump_generations(tasklist_ids)
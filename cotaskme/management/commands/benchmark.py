@@ -0,0 +1,277 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User, AnonymousUser
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+
+from optparse import make_option
+import collections, json, random, subprocess, time
+
+try:
+    import tracemalloc # Python 3.4+
+except ImportError:
+    tracemalloc = None
+
+from cotaskme.models import TaskList, Task
+from cotaskme.profiling import percentile
+from cotaskme.management.commands.generate_data import populate, last_id
+
+MEMORY_SAMPLES = 10 # extra requests run with memory tracing, which slows them down
+
+class Command(BaseCommand):
+    args = "[scenario ...]"
+    help = "Times common operations in a throwaway test database. Give the names of scenarios to run (bulk_post, claim, post, render, requests, state_matrix), or run them all. Save the results with --save and compare them with a run on another commit with --compare."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--tasks', type="int", default=1000, help="Number of tasks each scenario works on."),
+        make_option('--requests', type="int", default=200, help="Number of times the requests scenario makes each request."),
+        make_option('--data-users', type="int", default=1000, help="Number of users in the dataset the requests scenario generates."),
+        make_option('--data-tasks', type="int", default=100000, help="Number of tasks in the dataset the requests scenario generates."),
+        make_option('--save', metavar="FILE", help="Write the results to FILE as JSON."),
+        make_option('--compare', metavar="FILE", help="Compare the results with those saved in FILE."),
+    )
+
+    def scenarios(self):
+        return sorted(name[len("scenario_"):] for name in dir(self) if name.startswith("scenario_"))
+
+    def handle(self, *args, **options):
+        for name in args:
+            if name not in self.scenarios():
+                raise CommandError("Unknown scenario %s. Choose from: %s." % (name, ", ".join(self.scenarios())))
+
+        self.results = collections.OrderedDict()
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for name in (args or self.scenarios()):
+                self.stdout.write("%s:" % name)
+                getattr(self, "scenario_" + name)(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options["save"]:
+            with open(options["save"], "w") as f:
+                json.dump({
+                    "commit": get_commit(),
+                    "options": dict((k, options[k]) for k in ("tasks", "requests", "data_users", "data_tasks")),
+                    "results": self.results,
+                    }, f, indent=2)
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                self.compare(json.load(f))
+
+    def measure(self, label, count, func):
+        # Runs func, reporting its throughput and the number of statements it ran.
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+        self.stdout.write("  %-40s %8.1f ms %10.0f/sec %8.3f queries each" % (
+            label, elapsed * 1000, count / elapsed, len(queries) / float(count)))
+        self.results[label] = { "ms": elapsed * 1000, "per_sec": count / elapsed, "queries": len(queries) / float(count) }
+
+    def measure_requests(self, label, count, request):
+        # Calls request(i) for i from 0 to count + MEMORY_SAMPLES, each of
+        # which makes one request. The first warms up caches and isn't
+        # counted. The next count are timed, reporting the percentiles of
+        # their latencies and their average number of statements. The rest
+        # are run with memory tracing (where available), reporting the
+        # median of the peak memory each allocated.
+        latencies = []
+        num_queries = 0
+        memory = []
+        for i in range(count + 1 + MEMORY_SAMPLES):
+            trace = i > count and tracemalloc is not None
+            if trace: tracemalloc.start()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                response = request(i)
+                elapsed = time.time() - start
+            if trace:
+                memory.append(tracemalloc.get_traced_memory()[1] / 1024.0)
+                tracemalloc.stop()
+            if response.status_code >= 400:
+                raise CommandError("%s returned status %d." % (label, response.status_code))
+            if 1 <= i <= count:
+                latencies.append(elapsed * 1000)
+                num_queries += len(queries)
+
+        result = dict(("p%d_ms" % p, percentile(latencies, p)) for p in (50, 90, 99))
+        result["queries"] = num_queries / float(count)
+        result["memory_kb"] = percentile(memory, 50) if memory else None
+        self.stdout.write("  %-40s p50 %7.1f  p90 %7.1f  p99 %7.1f ms %6.1f queries each %s" % (
+            label, result["p50_ms"], result["p90_ms"], result["p99_ms"], result["queries"],
+            ("%8.0f KB" % result["memory_kb"]) if memory else "(memory not traced)"))
+        self.results[label] = result
+
+    def compare(self, before):
+        # Prints the change in each result's time and number of statements
+        # from the saved results.
+        self.stdout.write("")
+        self.stdout.write("compared with %s:" % (before.get("commit") or "saved results"))
+        self.stdout.write("  %-40s %10s %10s %8s %14s" % ("", "before", "after", "change", "queries"))
+        for label, after in self.results.items():
+            if label not in before["results"]: continue
+            metric = "p50_ms" if "p50_ms" in after else "ms"
+            b, a = before["results"][label][metric], after[metric]
+            self.stdout.write("  %-40s %7.1f ms %7.1f ms %+7.0f%% %6.3f => %-6.3f" % (
+                label, b, a, (a - b) / b * 100 if b else 0, before["results"][label]["queries"], after["queries"]))
+
+    def new_user(self, username):
+        # A user with one task list of his own.
+        user = User.objects.create(username=username)
+        user.set_password("password")
+        user.save()
+        return user, TaskList.new(user)
+
+    def client(self, user=None):
+        # A test client, logged in as user if given.
+        client = Client()
+        if user: client.login(username=user.username, password="password")
+        return client
+
+    def scenario_bulk_post(self, options):
+        # Posting many tasks one at a time versus with Task.new_many,
+        # and then changing their states one at a time versus with
+        # Task.change_states.
+        n = options["tasks"]
+        assigner, outgoing = self.new_user("bulk-assigner")
+        assignee, incoming = self.new_user("bulk-assignee")
+
+        def post_one_at_a_time():
+            for i in range(n):
+                t = Task.new(assigner, outgoing, incoming)
+                t.title = "Task %d" % i
+                t.save()
+        def post_in_bulk():
+            Task.new_many(assigner, outgoing, [{ "incoming": incoming, "title": "Task %d" % i, "notes": "" } for i in range(n)])
+        self.measure("post, one at a time", n, post_one_at_a_time)
+        self.measure("post, Task.new_many", n, post_in_bulk)
+
+        tasks = list(Task.objects.filter(incoming=incoming).order_by("id"))
+        def accept_one_at_a_time():
+            for t in tasks[:n]:
+                Task.objects.get(id=t.id).change_state(assignee, 1)
+        def accept_in_bulk():
+            Task.change_states(assignee, [(t.id, 1) for t in tasks[n:]])
+        self.measure("change state, one at a time", n, accept_one_at_a_time)
+        self.measure("change state, Task.change_states", n, accept_in_bulk)
+
+    def scenario_post(self, options):
+        # Posting a task through /_post, the way the browser does, by a
+        # logged-in user and by an anonymous user.
+        n = options["tasks"]
+        assigner, outgoing = self.new_user("post-assigner")
+        assignee, incoming = self.new_user("post-assignee")
+        incoming.public_to_post = True # so anonymous users can post to it
+        incoming.save()
+
+        client = self.client(assigner)
+        def post():
+            for i in range(n):
+                client.post("/_post", { "title": "Task %d" % i, "note": "", "outgoing": outgoing.id, "incoming": incoming.id, "view_orientation": "outgoing" })
+        self.measure("/_post", n, post)
+
+        anonymous = self.client()
+        def post_anonymously():
+            claim_id = ""
+            for i in range(n):
+                res = anonymous.post("/_post", { "title": "Task %d" % i, "note": "", "incoming": incoming.id, "claim_id": claim_id, "assigner_email": "anonymous@example.com", "view_orientation": "outgoing" })
+                claim_id = json.loads(res.content.decode("utf8"))["anonymous_claim_id"]
+        self.measure("/_post, anonymous", n, post_anonymously)
+
+    def scenario_claim(self, options):
+        # Claiming the tasks an anonymous user posted, one at a time with
+        # Task.claim versus all at once with Task.claim_all, including a
+        # double-submitted claim.
+        n = options["tasks"]
+        claimer, outgoing = self.new_user("claimer")
+        assignee, incoming = self.new_user("claim-assignee")
+        incoming.public_to_post = True
+        incoming.save()
+
+        def post_anonymously(claim_id):
+            for i in range(n):
+                Task.new(AnonymousUser(), None, incoming, title="Task %d" % i, anonymous_claim_id=claim_id)
+
+        post_anonymously("a" * 32)
+        def claim_one_at_a_time():
+            for t in Task.objects.filter(anonymous_claim_id="a" * 32):
+                t.claim(claimer, "a" * 32)
+        self.measure("claim, one at a time", n, claim_one_at_a_time)
+
+        post_anonymously("b" * 32)
+        self.measure("claim, Task.claim_all", n, lambda : Task.claim_all(claimer, "b" * 32))
+        self.measure("claim again, Task.claim_all", n, lambda : Task.claim_all(claimer, "b" * 32))
+
+    def scenario_render(self, options):
+        # Rendering task rows with the task.html template versus the
+        # string builder in views.render_task_row.
+        from cotaskme.views import render_task_row, render_task_from_template
+        n = options["tasks"]
+        assigner, outgoing = self.new_user("render-assigner")
+        assignee, incoming = self.new_user("render-assignee")
+        Task.new_many(assigner, outgoing, [{ "incoming": incoming, "title": "Task <%d>" % i, "notes": "" } for i in range(n)])
+        tasks = list(Task.objects.filter(incoming=incoming).select_related("creator", "incoming", "outgoing"))
+        TaskList.prepare_titles_for_assigned_to([t.incoming for t in tasks] + [t.outgoing for t in tasks])
+        for t in tasks:
+            t.add_state_matrix_for(assignee)
+
+        for which_way in ("incoming", "outgoing"):
+            self.measure("%s rows, task.html" % which_way, n, lambda : [render_task_from_template(t, assignee, which_way) for t in tasks])
+            self.measure("%s rows, render_task_row" % which_way, n, lambda : [render_task_row(t, assignee, which_way) for t in tasks])
+
+    def scenario_state_matrix(self, options):
+        # Computing a task's transitions versus looking them up, for
+        # every key. (The role lookups, which both need, aren't timed.)
+        from cotaskme.models import STATE_MATRIX
+        n = options["tasks"]
+        keys = [(state, set(["admin"]) if in_admin else set(), set(["admin"]) if out_admin else set(), anonymous, rejected)
+            for state, in_admin, out_admin, anonymous, rejected in STATE_MATRIX]
+        self.measure("Task.compute_state_matrix", n * len(keys), lambda : [Task.compute_state_matrix(*k) for i in range(n) for k in keys])
+        self.measure("STATE_MATRIX lookup", n * len(keys), lambda : [STATE_MATRIX[Task.get_state_matrix_key(*k)] for i in range(n) for k in keys])
+
+    def scenario_requests(self, options):
+        # The main views, requested through the test client the way the
+        # browser requests them, against a generated dataset. One user
+        # posts tasks to another's list, and the other accepts them.
+        n = options["requests"]
+        random.seed(0)
+        first_list = last_id(TaskList)
+        first_task = last_id(Task)
+        self.stdout.write("  (generating %d tasks on the lists of %d users)" % (options["data_tasks"], options["data_users"]))
+        populate(options["data_tasks"], options["data_users"])
+        lists = list(TaskList.objects.filter(id__gt=first_list).order_by("id")[0:3])
+        users = [tl.owners.all()[0] for tl in lists]
+        lists[1].public_to_post = True
+        lists[1].save()
+        assigner, assignee, claimer = [self.client(u) for u in users]
+
+        for which_way in ("incoming", "outgoing"):
+            url = "/t/%s/%s" % (lists[0].slug, which_way)
+            self.measure_requests("GET " + url, n, lambda i : assigner.get(url))
+
+        self.measure_requests("POST /_post", n, lambda i : assigner.post("/_post", {
+            "title": "Benchmark task %d" % i, "note": "", "outgoing": lists[0].id, "incoming": lists[1].id, "view_orientation": "outgoing" }))
+
+        tasks = list(Task.objects.filter(incoming=lists[1], title__startswith="Benchmark task ").order_by("id").values_list("id", flat=True))
+        self.measure_requests("POST /_action (accept)", n, lambda i : assignee.post("/_action", {
+            "action": "task-state", "task": tasks[i], "state": 1 }))
+
+        usernames = list(User.objects.filter(handles__isnull=False).distinct().values_list("username", flat=True)[0:1000])
+        self.measure_requests("POST /_search_for_recipient", n, lambda i : assigner.post("/_search_for_recipient", {
+            "query": usernames[i % len(usernames)][:-1] }))
+
+        claim_ids = sorted(set(Task.objects.filter(id__gt=first_task).exclude(anonymous_claim_id="").values_list("anonymous_claim_id", flat=True)))
+        count = min(n, len(claim_ids) - 1 - MEMORY_SAMPLES)
+        if count > 0:
+            self.measure_requests("GET /_claim", count, lambda i : claimer.get("/_claim", { "id": claim_ids[i] }))
+        else:
+            self.stdout.write("  (not enough anonymous tasks to time /_claim; use a larger --data-tasks)")
+
+def get_commit():
+    # The current git commit, if there is one, to label saved results.
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,106 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Count
+from django.contrib.auth.models import User
+
+from optparse import make_option
+
+import random, time
+
+from cotaskme.models import TaskList, Task
+from cotaskme.management.commands.generate_data import populate
+from cotaskme.management.commands.upgrade_db import get_partial_index_sql, supports_partial_indexes
+
+# The single-column indexes Task had before the composite indexes.
+OLD_INDEXES = [
+    ("bench_task_incoming", ["incoming_id"]),
+    ("bench_task_outgoing", ["outgoing_id"]),
+    ("bench_task_creator", ["creator_id"]),
+]
+
+class Command(BaseCommand):
+    help = "Loads a synthetic dataset into a throwaway test database and reports the query plans and latencies of the hot Task queries with the old single-column indexes and with the current composite indexes. SQLite only."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--tasks', type="int", default=1000000, help="Number of tasks to generate."),
+        make_option('--lists', type="int", default=2000, help="Number of task lists (and users) to generate."),
+        make_option('--repeat', type="int", default=20, help="Number of times to run each query."),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("This benchmark only supports SQLite.")
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            random.seed(0)
+            self.stdout.write("Generating %d tasks on %d lists..." % (options["tasks"], options["lists"]))
+            populate(options["tasks"], options["lists"], events=False)
+            queries = get_queries()
+
+            self.drop_task_indexes()
+            for name, columns in OLD_INDEXES:
+                connection.cursor().execute("CREATE INDEX %s ON cotaskme_task (%s)" % (name, ", ".join(columns)))
+            before = self.run_queries("before (single-column indexes)", queries, options["repeat"])
+
+            self.drop_task_indexes()
+            for sql in connection.creation.sql_indexes_for_model(Task, no_style()):
+                connection.cursor().execute(sql)
+            if supports_partial_indexes():
+                for sql in get_partial_index_sql():
+                    connection.cursor().execute(sql)
+            after = self.run_queries("after (composite indexes)", queries, options["repeat"])
+
+            self.stdout.write("")
+            self.stdout.write("%-28s %12s %12s" % ("query", "before (ms)", "after (ms)"))
+            for name, _ in queries:
+                self.stdout.write("%-28s %12.3f %12.3f" % (name, before[name], after[name]))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def drop_task_indexes(self):
+        # Drop every non-automatic index on the Task table.
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='cotaskme_task' AND sql IS NOT NULL")
+        for (name,) in cursor.fetchall():
+            cursor.execute("DROP INDEX %s" % connection.ops.quote_name(name))
+        cursor.execute("ANALYZE")
+
+    def run_queries(self, label, queries, repeat):
+        connection.cursor().execute("ANALYZE")
+        self.stdout.write("")
+        self.stdout.write("== " + label)
+        ret = { }
+        for name, qs in queries:
+            sql, params = qs.query.sql_with_params()
+            cursor = connection.cursor()
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            self.stdout.write(name + ":")
+            for row in cursor.fetchall():
+                self.stdout.write("    " + str(row[-1]))
+
+            timings = []
+            for i in range(repeat):
+                t0 = time.time()
+                list(qs.all()) # .all() makes a fresh copy without a result cache
+                timings.append(time.time() - t0)
+            timings.sort()
+            ret[name] = timings[len(timings) // 2] * 1000.0 # median, in ms
+            self.stdout.write("    median %.3f ms" % ret[name])
+        return ret
+
+def get_queries():
+    # The hot Task queries, as issued by the views and models.
+    tl = TaskList.objects.order_by("id")[0]
+    user = User.objects.order_by("id")[0]
+    task = Task.objects.order_by("id")[0]
+    return [
+        ("incoming page", Task.objects.filter(incoming__in=[tl], state=0).order_by('-created', '-id')[0:51]),
+        ("incoming closed page", Task.objects.filter(incoming__in=[tl], state=3).order_by('-created', '-id')[0:51]),
+        ("incoming state counts", Task.objects.filter(incoming__in=[tl]).order_by().values_list("state").annotate(count=Count("id"))),
+        ("outgoing page", Task.objects.filter(outgoing__in=[tl], state=1).exclude(incoming__in=[tl]).order_by('-created', '-id')[0:51]),
+        ("creator page", Task.objects.filter(incoming__in=[tl], creator=user, state=0).order_by('-created', '-id')[0:51]),
+        ("open auto-finish dependents", Task.objects.filter(dependencies=task, auto_finish=True, state__in=(0, 1))),
+        ("tasks by creator", Task.objects.filter(creator=user).order_by('-created')[0:50]),
+    ]
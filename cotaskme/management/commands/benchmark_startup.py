@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from optparse import make_option
+import json, os, subprocess, sys, time
+
+# Run in a new Python process: loads the WSGI application, forks (as a
+# preforking server does) and makes a request in the child, then makes the
+# parent's first request and one more once everything is warm. Prints when
+# the application finished loading and how long each request took.
+CHILD = """
+import json, os, sys, time
+from wsgiref.util import setup_testing_defaults
+
+from cotaskme.wsgi import application
+from django.conf import settings
+settings.ALLOWED_HOSTS = ["*"] # the request's host is 127.0.0.1
+times = { "loaded": time.time() }
+
+def request(path):
+    environ = { "PATH_INFO": path }
+    setup_testing_defaults(environ)
+    status = []
+    response = application(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        for chunk in response: pass
+    finally:
+        if hasattr(response, "close"): response.close()
+    if not status[0].startswith(("2", "3")):
+        sys.stderr.write("%s returned %s\\n" % (path, status[0]))
+        sys.exit(1)
+
+path = sys.argv[1]
+r, w = os.pipe()
+pid = os.fork()
+if pid == 0:
+    # the forked worker's first request
+    os.close(r)
+    start = time.time()
+    request(path)
+    os.write(w, json.dumps(time.time() - start).encode("ascii"))
+    os._exit(0)
+os.close(w)
+forked = json.loads(os.read(r, 100).decode("ascii"))
+os.waitpid(pid, 0)
+
+start = time.time()
+request(path)
+times["first"] = time.time() - start
+start = time.time()
+request(path)
+times["warm"] = time.time() - start
+times["forked"] = forked
+print(json.dumps(times))
+"""
+
+class Command(BaseCommand):
+    help = "Times how long a new server process takes to answer its first request: from starting Python to loading the WSGI application, to the first response in a process forked from it (as in a preforking server), and to the first response in the process itself. Also times a request once everything is loaded. Uses the configured database and settings. Not available on Windows."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type="int", default=10, help="Number of processes to start."),
+        make_option('--path', default="/", help="The page to request, as an anonymous user."),
+    )
+
+    def handle(self, *args, **options):
+        if not hasattr(os, "fork"):
+            raise CommandError("This benchmark needs os.fork.")
+
+        env = dict(os.environ)
+        env.setdefault("DJANGO_SETTINGS_MODULE", "cotaskme.settings")
+
+        timings = { "loaded": [], "forked": [], "first": [], "warm": [] }
+        for i in range(options["repeat"]):
+            start = time.time()
+            output = subprocess.check_output([sys.executable, "-c", CHILD, options["path"]], cwd=settings.BASE_DIR, env=env)
+            times = json.loads(output.decode("ascii").strip().split("\n")[-1])
+            timings["loaded"].append(times["loaded"] - start)
+            timings["first"].append(times["loaded"] - start + times["first"])
+            timings["forked"].append(times["forked"])
+            timings["warm"].append(times["warm"])
+
+        for label, key in (
+                ("start to application loaded", "loaded"),
+                ("first request in a forked worker", "forked"),
+                ("start to first response", "first"),
+                ("request once loaded", "warm")):
+            values = sorted(timings[key])
+            self.stdout.write("  %-40s median %8.1f ms  max %8.1f ms" % (label, values[len(values) // 2] * 1000, values[-1] * 1000))
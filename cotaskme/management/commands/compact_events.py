@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from optparse import make_option
+import datetime
+
+from cotaskme.models import TaskEvent, TaskEventSummary
+
+class Command(BaseCommand):
+    help = "Rolls TaskEvents older than a cutoff into one TaskEventSummary per task and deletes them, so that the event table holds only recent history."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type="int", default=365, help="Keep events from this many days back."),
+        make_option('--batch', type="int", default=500, help="Number of tasks to compact per transaction."),
+    )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+        old_events = TaskEvent.objects.filter(created__lt=cutoff)
+        task_ids = sorted(set(old_events.values_list("task_id", flat=True)))
+
+        num_events = 0
+        for i in range(0, len(task_ids), options["batch"]):
+            batch = task_ids[i:i + options["batch"]]
+            with transaction.atomic():
+                summaries = dict((s.task_id, s) for s in TaskEventSummary.objects.filter(task__in=batch))
+                events = old_events.filter(task__in=batch)
+                for task_id, created, event_type, to_state in events.order_by("id").values_list("task_id", "created", "event_type", "to_state"):
+                    if task_id not in summaries:
+                        summaries[task_id] = TaskEventSummary(task_id=task_id)
+                    summaries[task_id].add(created, event_type, to_state)
+                    num_events += 1
+                for s in summaries.values():
+                    s.save()
+                # no new events can be older than the cutoff
+                events.delete()
+
+        self.stdout.write("Compacted %d events of %d tasks." % (num_events, len(task_ids)))
@@ -0,0 +1,160 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from optparse import make_option
+
+import datetime, random
+
+from cotaskme.models import TaskList, Task, TaskDependencyClosure, TaskEvent, TaskListCount, UserHandle, TASK_EVENT_TYPES
+
+class Command(BaseCommand):
+    help = "Adds a synthetic dataset to the database: users with handles, task lists with owners, posters and observers, tasks in every state with dependency chains, anonymous tasks waiting to be claimed, and each task's event history. Every user's password is 'password'. For development databases only."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type="int", default=1000, help="Number of users (and task lists) to generate."),
+        make_option('--tasks', type="int", default=100000, help="Number of tasks to generate."),
+        make_option('--no-events', action="store_false", dest="events", default=True, help="Don't generate task histories."),
+        make_option('--seed', type="int", default=0, help="Random seed, so that the same options give the same data."),
+    )
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        self.stdout.write("Generating %d tasks on the lists of %d users..." % (options["tasks"], options["users"]))
+        populate(options["tasks"], options["users"], events=options["events"])
+
+def populate(num_tasks, num_lists, batch_size=10000, events=True):
+    # Adds num_lists users, each with handles and a list of their own, and
+    # num_tasks tasks. Rows that already exist are left alone: the new rows
+    # are picked out by id, and are numbered after the existing rows so
+    # that their names don't collide with earlier runs.
+    first_user = last_id(User)
+    first_list = last_id(TaskList)
+    first_task = last_id(Task)
+
+    # Users, each owning one list. The password hash is computed once
+    # because hashing is deliberately slow.
+    password = make_password("password")
+    for start in range(0, num_lists, batch_size):
+        User.objects.bulk_create([
+            User(username="user%d" % (first_user + i), email="user%d@example.com" % (first_user + i), password=password)
+            for i in range(start, min(start + batch_size, num_lists))])
+    new_users = User.objects.filter(id__gt=first_user).order_by("id")
+    users = list(new_users.values_list("id", flat=True))
+    UserHandle.objects.bulk_create([
+        UserHandle(user_id=u, handle=h)
+        for u, username, email in new_users.values_list("id", "username", "email") for h in (username, email)])
+
+    for start in range(0, num_lists, batch_size):
+        TaskList.objects.bulk_create([
+            TaskList(slug="list%d" % (first_list + i), title="List %d" % (first_list + i), public_to_post=random.random() < .5, public_to_observe=random.random() < .1, notes="", metadata={})
+            for i in range(start, min(start + batch_size, num_lists))])
+    lists = list(TaskList.objects.filter(id__gt=first_list).order_by("id").values_list("id", flat=True))
+    TaskList.owners.through.objects.bulk_create([
+        TaskList.owners.through(tasklist_id=tl, user_id=u) for tl, u in zip(lists, users)])
+
+    # Some lists are shared with a few other users who may post to them
+    # or observe them.
+    for through, fraction in ((TaskList.posters.through, .2), (TaskList.observers.through, .1)):
+        rows = set()
+        for tl, owner in zip(lists, users):
+            if random.random() < fraction:
+                rows |= set((tl, u) for u in random.sample(users, min(5, len(users))) if u != owner)
+        through.objects.bulk_create([through(tasklist_id=tl, user_id=u) for tl, u in sorted(rows)])
+
+    # Tasks spread over a few years, mostly finished or closed as in a
+    # list with a long history. A few are posted anonymously, in groups
+    # sharing a claim id, and wait to be claimed. created/modified are
+    # auto-set fields, so turn that off while generating so the dates can
+    # be spread out.
+    now = timezone.now()
+    with auto_dates_off(Task, TaskEvent):
+        for start in range(0, num_tasks, batch_size):
+            batch = []
+            for i in range(start, min(start + batch_size, num_tasks)):
+                owner = random.randrange(num_lists)
+                incoming = random.randrange(num_lists) if random.random() < .7 else owner
+                created = now - datetime.timedelta(seconds=random.randrange(3 * 365 * 24 * 3600))
+                t = Task(
+                    created=created,
+                    modified=created,
+                    title="Task %d" % i,
+                    notes="",
+                    creator_id=users[owner],
+                    outgoing_id=lists[owner],
+                    incoming_id=lists[incoming],
+                    state=random.choice((0, 1, 2, 2, 3, 3, 3, 3, 3, 3)),
+                    auto_finish=random.random() < .05,
+                    metadata={},
+                    )
+                if random.random() < .01:
+                    t.creator_id = None
+                    t.outgoing_id = None
+                    t.state = 0
+                    t.anonymous_claim_id = "%032x" % (first_task + i // 3)
+                batch.append(t)
+            Task.objects.bulk_create(batch)
+
+        if events:
+            populate_events(first_task, batch_size)
+
+    # Dependency chains: each auto-finishing task depends on the task
+    # before it in its chain. A chain only runs to older tasks, so there
+    # are no cycles.
+    task_ids = list(Task.objects.filter(id__gt=first_task, auto_finish=True).order_by("id").values_list("id", flat=True))
+    edges = []
+    chain = []
+    for t in task_ids:
+        if chain and random.random() < .8:
+            edges.append((t, chain[-1]))
+            chain.append(t)
+        else:
+            chain = [t]
+    Task.dependencies.through.objects.bulk_create([
+        Task.dependencies.through(from_task_id=t, to_task_id=blocker) for t, blocker in edges])
+
+    # bulk_create doesn't send the signals that maintain these tables.
+    with transaction.atomic():
+        TaskDependencyClosure.rebuild()
+        TaskListCount.reconcile()
+
+def populate_events(first_task, batch_size):
+    # Gives each new task a "created" event by its creator and then a
+    # state change for each step it took to its current state, at times
+    # after it was created: accepted and finished by the owner of its
+    # incoming list, closed by its creator.
+    owners = dict(TaskList.owners.through.objects.values_list("tasklist_id", "user_id"))
+    created, state = TASK_EVENT_TYPES.index("created"), TASK_EVENT_TYPES.index("state")
+    tasks = Task.objects.filter(id__gt=first_task).order_by("id").values_list("id", "created", "state", "creator_id", "incoming_id", "outgoing_id")
+    last = first_task
+    while True:
+        batch = list(tasks.filter(id__gt=last)[0:batch_size])
+        if len(batch) == 0: break
+        last = batch[-1][0]
+        events = []
+        for task_id, when, to_state, creator_id, incoming_id, outgoing_id in batch:
+            events.append(TaskEvent(task_id=task_id, created=when, event_type=created, user_id=creator_id, incoming_id=incoming_id, outgoing_id=outgoing_id))
+            for s in range(to_state):
+                when += datetime.timedelta(seconds=random.randrange(14 * 24 * 3600))
+                events.append(TaskEvent(task_id=task_id, created=when, event_type=state, from_state=s, to_state=s + 1,
+                    user_id=creator_id if s == 2 else owners.get(incoming_id),
+                    incoming_id=incoming_id, outgoing_id=outgoing_id))
+        TaskEvent.objects.bulk_create(events)
+
+def last_id(model):
+    ids = model.objects.order_by("-id").values_list("id", flat=True)[0:1]
+    return ids[0] if ids else 0
+
+class auto_dates_off(object):
+    # Turns off auto_now and auto_now_add on the models' fields within
+    # a with block.
+    def __init__(self, *models):
+        self.fields = [f for m in models for f in m._meta.fields if getattr(f, "auto_now", False) or getattr(f, "auto_now_add", False)]
+    def __enter__(self):
+        self.saved = [(f.auto_now, f.auto_now_add) for f in self.fields]
+        for f in self.fields: f.auto_now = f.auto_now_add = False
+    def __exit__(self, *exc_info):
+        for f, (auto_now, auto_now_add) in zip(self.fields, self.saved):
+            f.auto_now, f.auto_now_add = auto_now, auto_now_add
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from optparse import make_option
+
+from cotaskme.models import TaskListCount, TASK_STATE_NAMES
+
+class Command(BaseCommand):
+    help = "Recomputes the per-list task counts (TaskListCount) from the tasks, reporting and fixing any that drifted."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action="store_true", default=False, help="Report drift without fixing it."),
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            drift = TaskListCount.reconcile()
+            for tasklist_id, state, which_way, stored, actual in drift:
+                self.stdout.write("TaskList %d, %s %s: counted %d, actually %d." % (tasklist_id, TASK_STATE_NAMES[state], which_way, stored, actual))
+            if options["dry_run"]:
+                transaction.set_rollback(True)
+        self.stdout.write("%d counts %s." % (len(drift), "were wrong" if options["dry_run"] else "fixed"))
@@ -0,0 +1,237 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection
+
+from optparse import make_option
+import errno, os, select, socket, time
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+MAX_REQUEST_SIZE = 16384
+MAX_PENDING_OUTPUT = 65536 # drop clients that fall this far behind
+
+class Command(BaseCommand):
+    help = "Runs the server that pushes task list change notifications to browsers as server-sent events. See cotaskme/push.py."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host', default="127.0.0.1", help="Address to listen on."),
+        make_option('--port', type="int", default=3013, help="Port to listen on."),
+        make_option('--heartbeat', type="int", default=25, help="Seconds between keep-alive messages."),
+    )
+
+    def handle(self, *args, **options):
+        path = getattr(settings, "COTASKME_PUSH_SOCKET", None)
+        if not path:
+            raise CommandError("Set COTASKME_PUSH_SOCKET in settings_local.py.")
+        self.stdout.write("Listening on %s:%d, receiving notifications on %s." % (options["host"], options["port"], path))
+        PushServer((options["host"], options["port"]), path, options["heartbeat"]).serve_forever()
+
+class Client(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = b""
+        self.outbuf = b""
+        self.tasklist_ids = None # set once the client has subscribed
+        self.closing = False # close once outbuf is sent
+
+class PushServer(object):
+    def __init__(self, address, notify_path, heartbeat):
+        self.heartbeat = heartbeat
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+
+        if os.path.exists(notify_path): os.unlink(notify_path)
+        self.notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.notify.bind(notify_path)
+        self.notify.setblocking(False)
+
+        self.poller = select.poll()
+        self.poller.register(self.listener.fileno(), select.POLLIN)
+        self.poller.register(self.notify.fileno(), select.POLLIN)
+        self.clients = { } # fd => Client
+        self.subscribers = { } # TaskList id => set of Clients
+
+    def serve_forever(self):
+        next_heartbeat = time.time() + self.heartbeat
+        while True:
+            try:
+                events = self.poller.poll(max(0, next_heartbeat - time.time()) * 1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR: continue
+                raise
+            for fd, event in events:
+                if fd == self.listener.fileno():
+                    self.accept()
+                elif fd == self.notify.fileno():
+                    self.receive_notifications()
+                elif fd in self.clients:
+                    self.service(self.clients[fd], event)
+            if time.time() >= next_heartbeat:
+                # SSE comments keep proxies from timing out idle streams
+                # and let us notice clients that went away.
+                for client in list(self.clients.values()):
+                    if client.tasklist_ids is not None:
+                        self.send(client, b":\n\n")
+                next_heartbeat = time.time() + self.heartbeat
+
+    def accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+                raise
+            sock.setblocking(False)
+            client = Client(sock)
+            self.clients[sock.fileno()] = client
+            self.poller.register(sock.fileno(), select.POLLIN)
+
+    def receive_notifications(self):
+        # Each datagram is a comma-separated list of TaskList ids.
+        while True:
+            try:
+                data = self.notify.recv(4096)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+                raise
+            clients = { }
+            for id in data.decode("ascii").split(","):
+                if not id.isdigit(): continue
+                for client in self.subscribers.get(int(id), []):
+                    clients.setdefault(client, []).append(id)
+            for client, ids in clients.items():
+                self.send(client, ("data: %s\n\n" % ",".join(ids)).encode("ascii"))
+
+    def service(self, client, event):
+        if event & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+            self.close(client)
+            return
+        if event & select.POLLIN:
+            try:
+                data = client.sock.recv(4096)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return
+                self.close(client)
+                return
+            if data == b"":
+                self.close(client)
+                return
+            if client.tasklist_ids is None:
+                client.inbuf += data
+                if b"\r\n\r\n" in client.inbuf:
+                    self.subscribe(client)
+                elif len(client.inbuf) > MAX_REQUEST_SIZE:
+                    self.close(client)
+            # Anything sent after the request is ignored.
+        if event & select.POLLOUT:
+            self.flush(client)
+
+    def subscribe(self, client):
+        # Parse the HTTP request, which is GET ...?list=slug.
+        try:
+            head = client.inbuf.split(b"\r\n\r\n", 1)[0].decode("latin-1")
+            lines = head.split("\r\n")
+            method, path, version = lines[0].split(" ")
+            headers = dict((k.strip().lower(), v.strip()) for k, v in (line.split(":", 1) for line in lines[1:] if ":" in line))
+            slug = parse_qs(urlparse(path).query).get("list", [""])[0]
+        except ValueError:
+            self.respond_and_close(client, "400 Bad Request")
+            return
+
+        tasklist_ids = get_tasklist_ids_for_subscriber(headers.get("cookie", ""), slug)
+        if tasklist_ids is None:
+            self.respond_and_close(client, "403 Forbidden")
+            return
+
+        client.tasklist_ids = tasklist_ids
+        for id in tasklist_ids:
+            self.subscribers.setdefault(id, set()).add(client)
+        self.send(client, b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"X-Accel-Buffering: no\r\n"
+            b"\r\n"
+            b"retry: 10000\n\n")
+
+    def respond_and_close(self, client, status):
+        client.tasklist_ids = set()
+        client.closing = True
+        self.send(client, ("HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % status).encode("ascii"))
+
+    def send(self, client, data):
+        client.outbuf += data
+        if len(client.outbuf) > MAX_PENDING_OUTPUT:
+            self.close(client)
+            return
+        self.flush(client)
+
+    def flush(self, client):
+        if client.sock.fileno() not in self.clients: return # already closed
+        try:
+            sent = client.sock.send(client.outbuf)
+            client.outbuf = client.outbuf[sent:]
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close(client)
+                return
+        if client.outbuf:
+            self.poller.modify(client.sock.fileno(), select.POLLIN | select.POLLOUT)
+        elif client.closing:
+            self.close(client)
+        else:
+            self.poller.modify(client.sock.fileno(), select.POLLIN)
+
+    def close(self, client):
+        fd = client.sock.fileno()
+        if fd in self.clients:
+            self.poller.unregister(fd)
+            del self.clients[fd]
+        for id in client.tasklist_ids or []:
+            self.subscribers.get(id, set()).discard(client)
+            if id in self.subscribers and not self.subscribers[id]:
+                del self.subscribers[id]
+        client.sock.close()
+
+def get_tasklist_ids_for_subscriber(cookie_header, slug):
+    # Returns the ids of the TaskLists that the user identified by the
+    # session cookie may subscribe to for the given list slug, using the
+    # same rules as the task list page, or None if the user may not.
+    from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, load_backend
+    from django.contrib.auth.models import AnonymousUser
+    from django.utils.importlib import import_module
+    from cotaskme.models import TaskList, TaskListRoles
+
+    try:
+        from http.cookies import SimpleCookie
+    except ImportError:
+        from Cookie import SimpleCookie
+
+    try:
+        cookies = SimpleCookie()
+        cookies.load(cookie_header)
+        user = AnonymousUser()
+        if settings.SESSION_COOKIE_NAME in cookies:
+            session = import_module(settings.SESSION_ENGINE).SessionStore(cookies[settings.SESSION_COOKIE_NAME].value)
+            if SESSION_KEY in session and BACKEND_SESSION_KEY in session:
+                user = load_backend(session[BACKEND_SESSION_KEY]).get_user(session[SESSION_KEY]) or AnonymousUser()
+
+        if not slug:
+            if not user.is_authenticated(): return None
+            return set(TaskListRoles.for_user(user).owned_ids())
+
+        try:
+            tl = TaskList.objects.get(slug=slug)
+        except TaskList.DoesNotExist:
+            return None
+        if len(tl.get_user_roles(user)) == 0: return None
+        return set([tl.id])
+    finally:
+        # Don't hold a database connection (or an SQLite lock) while idle.
+        connection.close()
@@ -0,0 +1,159 @@
+from django.core.management.base import NoArgsCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction, DatabaseError
+from django.db.models import get_models, get_app, F
+
+# Partial indexes can't be declared on Django models. Each is
+# (name, table, columns, condition). They are created on backends
+# that support partial indexes (SQLite 3.8+ and PostgreSQL).
+# %(true)s in a condition is replaced by the backend's literal for
+# True, so that the condition is written the way Django queries it.
+PARTIAL_INDEXES = [
+    # auto-finish propagation looks for open auto_finish dependents
+    ("cotaskme_task_open_auto_finish", "cotaskme_task", ["id"], "auto_finish = %(true)s AND state IN (0, 1)"),
+
+    # only anonymously created tasks have a claim id
+    ("cotaskme_task_anonymous_claim_id", "cotaskme_task", ["anonymous_claim_id"], "anonymous_claim_id <> ''"),
+]
+
+class Command(NoArgsCommand):
+    help = "Brings the schema of an existing database up to date with changes that syncdb does not make, such as new indexes."
+
+    def handle_noargs(self, **options):
+        self.add_model_columns()
+        self.create_model_indexes()
+        self.create_partial_indexes()
+        self.direct_dependencies()
+        self.build_dependency_closure()
+        self.convert_task_events()
+        self.count_tasks()
+
+    def execute_sql(self, sql):
+        # Run a DDL statement, returning False if it failed because the
+        # object it creates already exists.
+        try:
+            with transaction.atomic():
+                connection.cursor().execute(sql)
+            return True
+        except DatabaseError as e:
+            if "already exists" in str(e): return False
+            raise
+
+    def add_model_columns(self):
+        # Add columns for fields that were added to existing models. They
+        # are added as nullable because the existing rows have no values
+        # for them; the steps below fill them in.
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        tables = connection.introspection.table_names(cursor)
+        for model in get_models(get_app("cotaskme")):
+            table = model._meta.db_table
+            if table not in tables: continue # syncdb creates new tables
+            columns = set(c[0] for c in connection.introspection.get_table_description(cursor, table))
+            for field in model._meta.local_fields:
+                if field.column in columns or field.db_type(connection) is None: continue
+                sql = "ALTER TABLE %s ADD COLUMN %s %s NULL" % (qn(table), qn(field.column), field.db_type(connection))
+                self.execute_sql(sql)
+                self.stdout.write(sql)
+
+    def create_model_indexes(self):
+        # Create any index (including index_together) that syncdb would
+        # create for a new database but that is missing from this one.
+        for model in get_models(get_app("cotaskme"), include_auto_created=True):
+            for sql in connection.creation.sql_indexes_for_model(model, no_style()):
+                if self.execute_sql(sql):
+                    self.stdout.write(sql)
+
+    def create_partial_indexes(self):
+        if not supports_partial_indexes():
+            self.stdout.write("This database does not support partial indexes. Skipping them.")
+            return
+        for sql in get_partial_index_sql():
+            if self.execute_sql(sql):
+                self.stdout.write(sql)
+
+    def direct_dependencies(self):
+        # Task.dependencies used to be symmetrical, storing each dependency
+        # as a pair of rows, one in each direction. Now that the direction
+        # matters, keep one row of each pair. Dependencies were only made by
+        # Task.new_dependency, which creates the blocker as a new task, so
+        # the dependent is the older task, with the lower id. Also drop any
+        # task that depended on itself. The closure rejects cycles, so once
+        # it is built no such rows can be added again.
+        from cotaskme.models import Task
+        edges = Task.dependencies.through.objects.all()
+        forward = set(edges.filter(from_task__lt=F("to_task")).values_list("from_task_id", "to_task_id"))
+        drop = [id for id, from_id, to_id in edges.filter(from_task__gte=F("to_task")).values_list("id", "from_task_id", "to_task_id")
+            if from_id == to_id or (to_id, from_id) in forward]
+        for i in range(0, len(drop), 500):
+            edges.filter(id__in=drop[i:i+500]).delete()
+        if drop:
+            self.stdout.write("Removed %d reversed or self task dependencies." % len(drop))
+
+    def build_dependency_closure(self):
+        # Fill in TaskDependencyClosure for dependencies that were added
+        # before it existed.
+        from cotaskme.models import Task, TaskDependencyClosure
+        if TaskDependencyClosure.objects.exists() or not Task.dependencies.through.objects.exists():
+            return
+        with transaction.atomic():
+            TaskDependencyClosure.rebuild()
+        self.stdout.write("Built the task dependency closure (%d rows)." % TaskDependencyClosure.objects.count())
+
+    def convert_task_events(self):
+        # TaskEvents used to keep everything in event_data. Move the fields
+        # that now have columns into them, leaving just the extras.
+        from cotaskme.models import TaskEvent, TASK_EVENT_TYPES
+        converted = 0
+        while True:
+            with transaction.atomic():
+                events = list(TaskEvent.objects.filter(event_type=None).only("id", "event_data")[0:1000])
+                if len(events) == 0: break
+                for e in events:
+                    data = dict(e.event_data or { })
+                    fields = {
+                        "event_type": TASK_EVENT_TYPES.index(data.pop("type", "state")),
+                        "user": data.pop("user", None),
+                        "from_state": data.pop("from", None),
+                        "to_state": data.pop("to", None),
+                        "incoming": data.pop("incoming", None),
+                        "outgoing": data.pop("outgoing", None),
+                    }
+                    if fields["user"] == "anonymous": fields["user"] = None
+                    if not data.get("dependent"): data.pop("dependent", None) # 0 meant none
+                    fields["event_data"] = data or None
+                    TaskEvent.objects.filter(id=e.id).update(**fields)
+                converted += len(events)
+        if converted:
+            # Created events knew their lists; fill in the rest from the tasks.
+            from cotaskme.models import Task
+            for field in ("incoming", "outgoing"):
+                for task_id, list_id in Task.objects.filter(events__in=TaskEvent.objects.filter(**{ field: None })).values_list("id", field + "_id").distinct():
+                    if list_id is not None:
+                        TaskEvent.objects.filter(task=task_id, **{ field: None }).update(**{ field: list_id })
+            self.stdout.write("Converted %d TaskEvents." % converted)
+
+    def count_tasks(self):
+        # Fill in TaskListCount for tasks created before it existed.
+        from cotaskme.models import Task, TaskListCount
+        if TaskListCount.objects.exists() or not Task.objects.exists():
+            return
+        with transaction.atomic():
+            TaskListCount.reconcile()
+        self.stdout.write("Counted the tasks on each list.")
+
+def supports_partial_indexes():
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 8, 0)
+    return False
+
+def get_partial_index_sql():
+    qn = connection.ops.quote_name
+    literals = { "true": "1" if connection.vendor == "sqlite" else "true" }
+    return [
+        "CREATE INDEX %s ON %s (%s) WHERE %s" % (qn(name), qn(table), ", ".join(qn(c) for c in columns), condition % literals)
+        for name, table, columns, condition in PARTIAL_INDEXES
+    ]
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from django.db import models
+from django.db import models, transaction, connection
+from django.db.models import F, Count
+from django.db.utils import OperationalError, IntegrityError
 from django.contrib.auth.models import User
+from django.utils import timezone
 
-import random
+import copy, itertools, json, random, time
 
 from jsonfield import JSONField
 
@@ -15,6 +18,8 @@ TASK_LIST_SLUG_OTHER_CHARS = "-_"
 TASK_LIST_SLUG_CHARS = TASK_LIST_SLUG_AUTO_CHARS + TASK_LIST_SLUG_OTHER_CHARS
 TASK_LIST_SLUG_CHAR_DESCRIPTION = "letters, numbers, dashes, and underscores"
 TASK_STATE_NAMES = ("Inbox", "Active", "Finished", "Closed")
+TASK_EVENT_TYPES = ("created", "state", "claimed") # stored by index
+STATE_CHANGE_ATTEMPTS = 5
 TASK_STATE_VERBS = {
     (0, 1): ("Accept", "arrow-down"),
     (0, 2): ("Finish", "ok"),
@@ -36,6 +41,88 @@ TASK_STATE_VERBS = {
     (3, "DELETE"): ("Delete", "remove"),
 }
 
+class TaskListRoles(object):
+    """Resolves a user's roles on TaskLists without per-list queries.
+
+    The TaskLists a user owns and the ids of the lists he can post to and
+    observe are each loaded with one query the first time they are needed
+    and memoized on the user object. Since request.user is created fresh
+    for each request, a request loads each at most once, and a page that
+    only needs the user's own lists queries only those. They are
+    deliberately not cached across requests: permissions must never be
+    decided from a copy that another server process could have made
+    stale."""
+
+    def __init__(self, user):
+        self.user = user
+        self.invalidate()
+
+    @staticmethod
+    def for_user(user):
+        roles = getattr(user, "_tasklist_roles", None)
+        if roles is None:
+            roles = TaskListRoles(user)
+            user._tasklist_roles = roles
+        return roles
+
+    def invalidate(self):
+        """Forget what has been loaded, e.g. after the user's memberships change."""
+        self._owned = None
+        self._owned_ids = None
+        self._member_ids = { }
+
+    @staticmethod
+    def get_owned_lists(user_ids):
+        """Returns a dict from user id to the TaskLists the user owns,
+        ordered by id, loading them for all of the users with one query."""
+        user_ids = set(user_ids)
+        ret = dict((id, []) for id in user_ids)
+        if len(user_ids) == 0: return ret
+        for ownership in TaskList.owners.through.objects.filter(user__in=user_ids).select_related("tasklist").order_by("tasklist"):
+            ret[ownership.user_id].append(ownership.tasklist)
+        return ret
+
+    def owned_lists(self):
+        """The TaskLists the user owns, ordered by id."""
+        if self._owned is None:
+            if not self.user.is_authenticated():
+                self._owned = []
+            else:
+                self._owned = TaskListRoles.get_owned_lists([self.user.id])[self.user.id]
+            self._owned_ids = frozenset(tl.id for tl in self._owned)
+        return self._owned
+
+    def owned_ids(self):
+        self.owned_lists()
+        return self._owned_ids
+
+    def get_member_ids(self, relation):
+        # The ids of the lists that have the user among their posters or
+        # observers.
+        if relation not in self._member_ids:
+            if not self.user.is_authenticated():
+                self._member_ids[relation] = frozenset()
+            else:
+                self._member_ids[relation] = frozenset(getattr(TaskList, relation).through.objects.filter(user=self.user).values_list("tasklist_id", flat=True))
+        return self._member_ids[relation]
+
+    def postable_ids(self):
+        return self.get_member_ids("posters")
+
+    def observed_ids(self):
+        return self.get_member_ids("observers")
+
+    def get_roles(self, tasklist):
+        # The public flags are checked first so that the posters and
+        # observers are only loaded when they decide the role.
+        if tasklist.id in self.owned_ids(): return set(["admin", "post", "observe"])
+        ret = set()
+        if tasklist.public_to_post or tasklist.id in self.postable_ids():
+            ret.add("post")
+        if tasklist.public_to_observe or tasklist.id in self.observed_ids():
+            ret.add("observe")
+        return ret
+
 class TaskList(models.Model):
     created = models.DateTimeField(auto_now_add=True, db_index=True)
     modified = models.DateTimeField(auto_now=True, db_index=True)
@@ -64,6 +151,7 @@ class TaskList(models.Model):
         tl.notes = ""
         tl.save()
         tl.owners.add(owner)
+        TaskListRoles.for_user(owner).invalidate()
         return tl
 
     @staticmethod
@@ -75,21 +163,62 @@ class TaskList(models.Model):
         # tasks lists? If the list is owned by a single user and that
         # user has just one list, display the owner's username. Otherwise
         # display the title of this list.
+        if hasattr(self, "_title_for_assigned_to"):
+            # precomputed by prepare_titles_for_assigned_to
+            return self._title_for_assigned_to
         if self.owners.count() == 1:
             owner = self.owners.first()
             if owner.tasklists_owned.count() <= 1:
                 return str(owner)
         return self.title
 
+    @staticmethod
+    def prepare_titles_for_assigned_to(tasklists):
+        """Precomputes title_for_assigned_to for any number of TaskList
+        instances using two queries: one for the owners of the lists and one
+        for the number of lists owned by each sole owner."""
+        from cotaskme import caching
+        tasklists = [tl for tl in tasklists if tl is not None]
+        if len(tasklists) == 0: return
+
+        # Use cached titles where possible.
+        gens = caching.get_generations(tl.id for tl in tasklists)
+        cached = caching.get_titles_for_assigned_to(tasklists, gens)
+        for tl in tasklists:
+            if tl.id in cached:
+                tl._title_for_assigned_to = cached[tl.id]
+        tasklists = [tl for tl in tasklists if tl.id not in cached]
+        if len(tasklists) == 0: return
+
+        owners = { }
+        for ownership in TaskList.owners.through.objects.filter(tasklist__in=set(tl.id for tl in tasklists)).select_related("user"):
+            owners.setdefault(ownership.tasklist_id, []).append(ownership.user)
+
+        sole_owner_ids = set(users[0].id for users in owners.values() if len(users) == 1)
+        lists_owned = { }
+        if len(sole_owner_ids) > 0:
+            lists_owned = dict(TaskList.owners.through.objects.filter(user__in=sole_owner_ids)
+                .values_list("user").annotate(count=models.Count("id")))
+
+        for tl in tasklists:
+            users = owners.get(tl.id, [])
+            if len(users) == 1 and lists_owned.get(users[0].id, 0) <= 1:
+                tl._title_for_assigned_to = str(users[0])
+            else:
+                tl._title_for_assigned_to = tl.title
+
+        caching.set_titles_for_assigned_to(dict((tl.id, tl._title_for_assigned_to) for tl in tasklists), gens)
+
     def get_user_roles(self, user):
         """Returns whether the user has permission to administer, post to, or observe the contents of the TaskList."""
-        if user in self.owners.all(): return set(["admin", "post", "observe"])
-        ret = set()
-        if self.public_to_post or user in self.posters.all():
-            ret.add("post")
-        if self.public_to_observe or user in self.observers.all():
-            ret.add("observe")
-        return ret
+        return TaskListRoles.for_user(user).get_roles(self)
+
+    @staticmethod
+    def touch(tasklist_ids):
+        """Updates the modified time of TaskLists, e.g. when the tasks on
+        them change, so that cached copies of their pages are refreshed."""
+        tasklist_ids = [id for id in tasklist_ids if id is not None]
+        TaskList.objects.filter(id__in=tasklist_ids).update(modified=timezone.now())
 
     def get_owners(self):
         return ", ".join( str(user) for user in self.owners.all() )
@@ -117,19 +246,36 @@ class Task(models.Model):
     created = models.DateTimeField(auto_now_add=True, db_index=True)
     modified = models.DateTimeField(auto_now=True, db_index=True)
     title = models.CharField(max_length=400)
-    creator = models.ForeignKey(User, blank=True, null=True, db_index=True, related_name="tasks_created")
+    creator = models.ForeignKey(User, blank=True, null=True, db_index=False, related_name="tasks_created")
     notes = models.TextField(blank=True)
-    outgoing = models.ForeignKey(TaskList, blank=True, null=True, db_index=True, related_name="tasks_outgoing", on_delete=models.PROTECT)
-    incoming = models.ForeignKey(TaskList, db_index=True, related_name="tasks_incoming", on_delete=models.PROTECT)
+    outgoing = models.ForeignKey(TaskList, blank=True, null=True, db_index=False, related_name="tasks_outgoing", on_delete=models.PROTECT)
+    incoming = models.ForeignKey(TaskList, db_index=False, related_name="tasks_incoming", on_delete=models.PROTECT)
     state = models.IntegerField(choices=enumerate(TASK_STATE_NAMES))
     hidden_on_outgoing = models.BooleanField(default=False)
     hidden_on_incoming = models.BooleanField(default=False)
     auto_close = models.BooleanField(default=False, help_text="Automatically close a task when it is finished.")
-    dependencies = models.ManyToManyField('self', blank=True, db_index=True)
+    dependencies = models.ManyToManyField('self', blank=True, db_index=True, symmetrical=False, related_name="dependents")
     auto_finish = models.BooleanField(default=False, help_text="Automatically finish a task when its dependencies are closed or finished.")
     metadata = JSONField()
     anonymous_claim_id = models.CharField(max_length=32, blank=True, db_index=True, help_text="For anonymously-created tasks, a random string that allows the user to claim it after registering.")
 
+    class Meta:
+        # Composite indexes matched to how tasks are queried. They also serve
+        # plain lookups on their first column, so incoming, outgoing, and
+        # creator don't get indexes of their own. Partial indexes, which
+        # Django can't declare, are created by the upgrade_db command.
+        index_together = [
+            # incoming task list pages: a list's tasks in a state, newest first
+            ("incoming", "state", "created"),
+            # outgoing task list pages: the same, by the assigning list
+            ("outgoing", "state", "created"),
+            # tasks a user posted to a list he can't observe, and claiming
+            ("creator", "state", "created"),
+            # the latest change on a list's pages, for their ETags
+            ("incoming", "modified"),
+            ("outgoing", "modified"),
+        ]
+
     def __str__(self):
         return \
             self.created.isoformat() \
@@ -140,8 +286,10 @@ class Task(models.Model):
             + ": " + self.title
 
     @staticmethod
-    def new(user, outgoing, incoming, dependent=None):
-        """Creates a new Task."""
+    def new(user, outgoing, incoming, dependent=None, title=None, notes=None, metadata=None, anonymous_claim_id=""):
+        """Creates a new Task. The title and notes default to the dependent
+        task's, if given. The task and its TaskEvent are written in a single
+        transaction, with one INSERT each."""
 
         if outgoing and "admin" not in outgoing.get_user_roles(user): raise ValueError("User does not have permission to post an outgoing task on the outgoing task list.")
         if "post" not in incoming.get_user_roles(user): raise ValueError("User does not have permission to post a task on the incoming task list.")
@@ -149,9 +297,9 @@ class Task(models.Model):
         # TODO: validate information on anonymous tasks (outgoing=None)
 
         t = Task()
-        t.title = "New Task" if not dependent else dependent.title
+        t.title = title if title is not None else ("New Task" if not dependent else dependent.title)
         t.creator = user if user.is_authenticated() else None
-        t.notes = "" if not dependent else dependent.notes
+        t.notes = notes if notes is not None else ("" if not dependent else dependent.notes)
         t.outgoing = outgoing
         t.incoming = incoming
         if incoming == outgoing:
@@ -160,21 +308,83 @@ class Task(models.Model):
         else:
             # Put the task in the inbox.
             t.state = 0
-        t.save()
+        if metadata is not None: t.metadata = metadata
+        t.anonymous_claim_id = anonymous_claim_id
 
-        e = TaskEvent()
-        e.task = t
-        e.event_data = {
-            "type": "created",
-            "user": user.id if user.is_authenticated() else "anonymous",
-            "outgoing": outgoing.id if outgoing else None,
-            "incoming": incoming.id,
-            "dependent": 0  if not dependent else dependent.id,
-        }
-        e.save()
+        with push.deferred(), transaction.atomic():
+            t.save()
+            TaskListCount.adjust(TaskListCount.task_delta(None, t))
+            if not dependent:
+                TaskEvent.record(t, "created", user)
+            else:
+                TaskEvent.record(t, "created", user, dependent=dependent.id)
 
         return t
 
+    @staticmethod
+    def new_many(user, outgoing, posts):
+        """Creates many Tasks from the outgoing TaskList at once. posts is a
+        list of dicts with keys incoming (a TaskList), title, and notes.
+        Permissions are checked once per TaskList, and the tasks and their
+        TaskEvents are written in a single transaction with bulk INSERTs
+        (on SQLite; elsewhere the tasks are inserted one at a time).
+        Returns a list with, for each post, either the new Task or a
+        ValueError saying why it was not created."""
+
+        if not user.is_authenticated(): raise ValueError("You must be logged in to post tasks in bulk.")
+        if "admin" not in outgoing.get_user_roles(user): raise ValueError("User does not have permission to post an outgoing task on the outgoing task list.")
+
+        ret = []
+        tasks = []
+        for post in posts:
+            incoming = post["incoming"]
+            if "post" not in incoming.get_user_roles(user): # memoized per list
+                ret.append(ValueError("User does not have permission to post a task on the incoming task list."))
+                continue
+            t = Task()
+            t.title = post["title"]
+            t.creator = user
+            t.notes = post["notes"]
+            t.outgoing = outgoing
+            t.incoming = incoming
+            t.state = 1 if incoming == outgoing else 0
+            ret.append(t)
+            tasks.append(t)
+        if len(tasks) == 0: return ret
+
+        counts = { }
+        with push.deferred(), transaction.atomic(), TaskEventBatch() as batch:
+            if connection.vendor == "sqlite":
+                # bulk_create doesn't set the new tasks' ids, so read them
+                # back: they are the newest tasks this user created on this
+                # list since the INSERT started, in order. That is only
+                # safe because on SQLite the INSERT takes the database's
+                # write lock until the transaction ends, so no other tasks
+                # can be created in between.
+                start = timezone.now()
+                Task.objects.bulk_create(tasks)
+                ids = list(Task.objects.filter(outgoing=outgoing, creator=user, created__gte=start)
+                    .order_by("-id").values_list("id", "title")[0:len(tasks)])
+                ids.reverse()
+                if [title for id, title in ids] != [t.title for t in tasks]:
+                    raise Exception("Could not read back the ids of the new tasks.") # rolls back
+                for t, (id, title) in zip(tasks, ids):
+                    t.id = id
+            else:
+                # Other databases let concurrent transactions insert tasks
+                # between ours, so the ids can't be read back that way.
+                # Insert the tasks one at a time instead.
+                for t in tasks:
+                    t.save()
+            for t in tasks:
+                TaskListCount.task_delta(None, t, counts)
+                TaskEvent.record(t, "created", user, events=batch.events)
+                batch.flush_if_full()
+
+            TaskListCount.adjust(counts)
+
+        return ret
+
     def claim(self, by_user, claim_id):
         # Let a task that was created previously by an anonymous user
         # be claimed (and now owned by) a real user.
@@ -187,48 +397,123 @@ class Task(models.Model):
         # A user might own more than one list, but we don't really suppor that
         # in the UI, so just take the first.
         try:
-            outgoing = TaskList.objects.filter(owners=by_user)[0]
+            outgoing = TaskListRoles.for_user(by_user).owned_lists()[0]
         except IndexError:
             raise ValueError()
 
         # Update the task.
+        before = copy.copy(self)
         self.creator = by_user
         self.outgoing = outgoing
-        self.anonymous_claim_id = None
+        self.anonymous_claim_id = ""
         if self.state == 0 and self.incoming == self.outgoing:
             # if the user anonymously assigned the task to himself, immediately
             # promote it out of Inbox
             self.state = 1
-        self.save()
+        with push.deferred(), transaction.atomic():
+            self.save()
+            TaskListCount.adjust(TaskListCount.task_delta(before, self))
 
-        # Record the event.
-        e = TaskEvent()
-        e.task = self
-        e.event_data = {
-            "type": "claimed",
-            "user": by_user.id,
-        }
-        e.save()
+            # Record the event.
+            TaskEvent.record(self, "claimed", by_user)
+
+    @staticmethod
+    def claim_all(by_user, claim_id):
+        """Lets a user claim all of the tasks created anonymously with the
+        given claim id, as claim does for one task, with a few set-based
+        UPDATEs and one bulk INSERT of TaskEvents in one transaction.
+        Claiming is idempotent: claiming again (say, because the request
+        was submitted twice) finds no tasks left to claim. Returns a list
+        of (id, incoming id, outgoing id, state) for the claimed tasks."""
+
+        if not by_user.is_authenticated(): raise ValueError()
+        if not claim_id: raise ValueError()
+
+        # As in claim, the tasks go on the user's first list.
+        try:
+            outgoing = TaskListRoles.for_user(by_user).owned_lists()[0]
+        except IndexError:
+            raise ValueError()
+
+        now = timezone.now()
+        with push.deferred(), transaction.atomic(), TaskEventBatch() as batch:
+            # Take the tasks first. The conditional UPDATE locks them, so
+            # a concurrent claim waits and then finds nothing to take.
+            unclaimed = Task.objects.filter(anonymous_claim_id=claim_id, creator=None)
+            if unclaimed.update(creator=by_user, modified=now) == 0:
+                return []
+            claimed = Task.objects.filter(anonymous_claim_id=claim_id, creator=by_user)
+            before = list(claimed.values_list("id", "incoming_id", "state"))
+
+            # If the user anonymously assigned tasks to himself, promote
+            # them out of the Inbox. Then move them all to his list.
+            claimed.filter(incoming=outgoing, state=0).update(state=1)
+            claimed.update(outgoing=outgoing, anonymous_claim_id="")
+
+            counts = { }
+            ret = []
+            for id, incoming_id, state in before:
+                new_state = 1 if state == 0 and incoming_id == outgoing.id else state
+                TaskListCount.task_delta((incoming_id, None, state), (incoming_id, outgoing.id, new_state), counts)
+                batch.events.append(TaskEvent(task_id=id, event_type=TASK_EVENT_TYPES.index("claimed"),
+                    user=by_user, incoming_id=incoming_id, outgoing_id=outgoing.id))
+                ret.append((id, incoming_id, outgoing.id, new_state))
+            TaskListCount.adjust(counts)
+
+        return ret
 
     def was_rejected(self):
         return isinstance(self.metadata, dict) and (self.metadata.get("rejected") == True)
 
     def new_dependency(self, user, incoming):
         """Creates a new dependency for the Task posted to another TaskList."""
-        return Task.new(user, self.incoming, incoming, self)
+        with push.deferred(), transaction.atomic():
+            t = Task.new(user, self.incoming, incoming, self)
+            self.dependencies.add(t)
+        return t
+
+    def all_blockers(self):
+        """Returns a QuerySet of all of the tasks this task depends on,
+        directly or indirectly."""
+        return Task.objects.filter(closure_dependents__task=self)
+
+    def all_dependents(self):
+        """Returns a QuerySet of all of the tasks that depend on this task,
+        directly or indirectly, i.e. everything finishing it could unblock."""
+        return Task.objects.filter(closure_blockers__blocker=self)
 
     def add_state_matrix_for(self, user):
-        self.state_matrix = []
-        for transition in self.get_state_matrix(user):
-            verb = TASK_STATE_VERBS[transition]
-            self.state_matrix.append( (transition[0], transition[1], verb) )
+        # the transitions with their verbs, for task.html
+        self.state_matrix = STATE_MATRIX_VERBS[self.state_matrix_key(user)]
 
     def get_state_matrix(self, user):
         """Which states can this user change the state of this task to?
         Note that he might be an owner of both the outgoing and incoming tasklists.
-        Here we prevent transitions directly between 0/1 and 3, which may or may not be desirable."""
+        The answer is looked up in STATE_MATRIX (see compute_state_matrix)."""
+        return STATE_MATRIX[self.state_matrix_key(user)]
+
+    def state_matrix_key(self, user):
+        # Everything the transitions depend on.
         in_roles = self.incoming.get_user_roles(user)
-        out_roles = self.outgoing.get_user_roles(user) if self.outgoing else set() # might be an anonymous task
+        out_roles = self.outgoing.get_user_roles(user) if self.outgoing_id else set() # might be an anonymous task
+        return Task.get_state_matrix_key(self.state, in_roles, out_roles, self.creator_id is None, self.was_rejected())
+
+    @staticmethod
+    def get_state_matrix_key(state, in_roles, out_roles, anonymous, rejected):
+        return (state, "admin" in in_roles, "admin" in out_roles, anonymous, rejected)
+
+    @staticmethod
+    def compute_state_matrix(state, in_roles, out_roles, anonymous, rejected):
+        """Computes the transitions (from state, to state[, is rejection])
+        available to a user with the given roles on the incoming and
+        outgoing lists of a task in the given state, which is anonymous
+        (has no creator) and/or rejected. Transitions from every state are
+        included so that the page can update a task's actions after
+        changing its state without rendering it again.
+        Here we prevent transitions directly between 0/1 and 3, which may or may not be desirable.
+
+        This is used to build STATE_MATRIX once; get_state_matrix looks
+        the transitions up there."""
         ret = set()
         if "admin" in in_roles:
             # An admin on the incoming list can move a task between states 0 (inbox), 1 (active),
@@ -241,7 +526,7 @@ class Task(models.Model):
                     if "admin" in out_roles and s2 == 0:
                         # self-assigned tasks cannot be moved to the inbox
                         continue
-                    elif ("admin" in out_roles or self.creator is None) and s2 == 2:
+                    elif ("admin" in out_roles or anonymous) and s2 == 2:
                         # self-assigned and anonymous tasks get closed instead of finished
                         if "admin" in out_roles and s1 == 0: continue # self-assigned tasks are never in state 0
                         ret.add((s1, 3))
@@ -252,7 +537,7 @@ class Task(models.Model):
                 ret.add((0, 3, True)) # reject
                 ret.add((3, 0)) # un-reject
 
-                if self.creator is None:
+                if anonymous:
                     # anonymous tasks can be deleted at any time
                     # (anomyous tasks are never in a finished state)
                     for s1 in (0, 1, 3):
@@ -273,13 +558,13 @@ class Task(models.Model):
             ret.add((2, 3))
             if "admin" not in in_roles:
                 # task is not self-assigend
-                if not self.was_rejected():
+                if not rejected:
                     # once a task is rejected, the asigner can't un-reject it
                     ret.add((3, 2))
                 ret.add((0, "DELETE")) # can delete only when the assignee has not yet acknowledged it
             else:
                 ret.add((3, 1))
-        return sorted(s for s in ret if s != self.state)
+        return sorted((s for s in ret if s != state), key=lambda s : [(isinstance(x, str), x) for x in s])
 
     def change_state(self, user, new_state):
         """Changes the state of a task. The incoming owners can move a
@@ -287,91 +572,661 @@ class Task(models.Model):
         move a Task between Finished to Closed. The creator of a Task has
         no special permission if he isn't an owner of either. To reject
         a task's outcome, the outgoing owner should close and start a new
-        task."""
+        task.
 
-        # TODO: This method needs some locking/synchronization.
+        The change, its TaskEvent, and any automatic changes that follow
+        from it are written in a single transaction. The state is updated
+        with a compare-and-set (UPDATE ... WHERE state=<the state we
+        checked permissions against>), so that if another request changed
+        the task concurrently nothing is lost: the task is reloaded and the
+        change is re-checked against its new state."""
 
-        if self.state == new_state: return
+        for attempt in range(STATE_CHANGE_ATTEMPTS):
+            snapshot = (self.state, copy.deepcopy(self.metadata), self.modified)
+            try:
+                with push.deferred(), transaction.atomic():
+                    self._change_state(user, new_state)
+                return
+            except StateConflict:
+                # Someone else changed the task first. Reload it and try again.
+                try:
+                    self.reload_state()
+                except Task.DoesNotExist:
+                    raise ValueError("The task was deleted.")
+            except OperationalError:
+                # The database is locked by another writer (SQLite). The
+                # transaction was rolled back, so roll back this instance too.
+                self.state, self.metadata, self.modified = snapshot
+                if attempt == STATE_CHANGE_ATTEMPTS - 1: raise
+                time.sleep(random.uniform(0, .05 * 2**attempt))
+        raise ValueError("The task is being changed by someone else. Please try again.")
 
-        # check permissions
-        is_rejection = False
-        if user:
-            for transition in self.get_state_matrix(user):
-                if transition[0] == self.state and transition[1] == new_state:
-                    # This is permitted.
+    @staticmethod
+    def change_states(user, changes):
+        """Changes the states of many tasks at once. changes is a list of
+        (task id, new state) pairs. Each change is checked in memory as in
+        change_state, and then the permitted changes are made in one
+        transaction with one compare-and-set UPDATE for each group of
+        tasks going from the same state to the same state, one bulk INSERT
+        of their TaskEvents, and one adjustment of the counts. Deletions
+        are made one at a time. A change that is not permitted, or whose
+        task was changed concurrently, is skipped without affecting the
+        others. Returns a list with, for each change, either the Task (with
+        its new state) or a ValueError saying why the change was not made."""
 
-                    # Check if this is a transition that marks the task as rejected.
-                    if len(transition) == 3: is_rejection = transition[2]
+        tasks = dict((t.id, t) for t in Task.objects.filter(id__in=set(id for id, state in changes)).select_related("incoming", "outgoing"))
+        ret = [None] * len(changes)
+        groups = { } # (old state, new state, metadata as JSON) => (metadata, [(index, Task)])
+        deletions = []
+        seen = set()
+        for i, (task_id, new_state) in enumerate(changes):
+            if task_id in seen:
+                ret[i] = ValueError("A task can only be changed once at a time.")
+                continue
+            seen.add(task_id)
+            t = tasks.get(task_id)
+            if t is None:
+                ret[i] = ValueError("The task was deleted.")
+                continue
+            ret[i] = t
+            try:
+                is_rejection = t.check_state_change(user, new_state)
+            except ValueError as e:
+                ret[i] = e
+                continue
+            if new_state == t.state:
+                continue
+            if new_state == "DELETE":
+                deletions.append((i, t))
+                continue
+            m = t.get_metadata_after_state_change(is_rejection)
+            key = (t.state, new_state, json.dumps(m, sort_keys=True))
+            groups.setdefault(key, (m, []))[1].append((i, t))
 
-                    break # flag that we've found the permitted transition
-            else:
-                # This is not permitted.
-                raise ValueError("You do not have permission to make that change.")
+        now = timezone.now()
+        with push.deferred(), transaction.atomic(), TaskEventBatch() as batch:
+            counts = { }
+            finished = []
+            for (old_state, new_state, m_json), (m, group) in sorted(groups.items()):
+                # Finishing an auto_close task closes it immediately.
+                for auto_close in (False, True):
+                    members = [(i, t) for i, t in group if t.auto_close == auto_close]
+                    if len(members) == 0: continue
+                    final_state = 3 if new_state == 2 and auto_close else new_state
+                    ids = [t.id for i, t in members]
+                    changed = set(ids)
+                    if Task.objects.filter(id__in=ids, state=old_state).update(state=final_state, metadata=m, modified=now) != len(ids):
+                        # Some of the tasks were changed concurrently. Find
+                        # the ones this UPDATE changed.
+                        changed = set(Task.objects.filter(id__in=ids, state=final_state, modified=now).values_list("id", flat=True))
+                    for i, t in members:
+                        if t.id not in changed:
+                            ret[i] = ValueError("The task is being changed by someone else. Please try again.")
+                            continue
+                        TaskListCount.task_delta((t.incoming_id, t.outgoing_id, old_state), (t.incoming_id, t.outgoing_id, final_state), counts)
+                        t.state = final_state
+                        t.metadata = m
+                        t.modified = now
+                        TaskEvent.record(t, "state", user, from_state=old_state, to_state=new_state, events=batch.events)
+                        if final_state != new_state:
+                            TaskEvent.record(t, "state", None, from_state=new_state, to_state=final_state, events=batch.events)
+                        if final_state in (2, 3):
+                            finished.append(t.id)
+                        batch.flush_if_full()
+            TaskListCount.adjust(counts)
 
-        if new_state == "DELETE":
-            # This is a hard delete of a task.
-            self.delete()
-            return
+            # A conflict while finishing the dependents can't be pinned on
+            # one change, so it fails them all.
+            try:
+                Task.propagate_autofinish(finished)
+            except StateConflict:
+                raise ValueError("The tasks are being changed by someone else. Please try again.")
 
-        # record change
-        e = TaskEvent()
-        e.task = self
-        e.event_data = {
-            "type": "state",
-            "user": user.id if user else None, # might be an automatic event
-            "from": self.state,
-            "to": new_state,
-        }
-        e.save()
-
-        # was this a rejection?
+            for i, t in deletions:
+                try:
+                    with transaction.atomic():
+                        t._change_state(user, "DELETE", batch.events)
+                except (ValueError, StateConflict) as e:
+                    if isinstance(e, StateConflict):
+                        e = ValueError("The task is being changed by someone else. Please try again.")
+                    ret[i] = e
+
+        return ret
+
+    def reload_state(self):
+        """Reloads the fields that change_state changes."""
+        t = Task.objects.get(id=self.id)
+        self.state = t.state
+        self.metadata = t.metadata
+        self.modified = t.modified
+
+    def check_state_change(self, user, new_state):
+        """Raises ValueError if user may not change the state of this task
+        to new_state. Otherwise returns whether the change marks the task
+        as rejected. user is None for automatic changes, which are always
+        permitted."""
+        if self.state == new_state or not user: return False
+        for transition in self.get_state_matrix(user):
+            if transition[0] == self.state and transition[1] == new_state:
+                # This is permitted. Check if this is a transition that
+                # marks the task as rejected.
+                return len(transition) == 3 and transition[2]
+        raise ValueError("You do not have permission to make that change.")
+
+    def get_metadata_after_state_change(self, is_rejection):
+        # A rejection marks the task as rejected, and any other change
+        # unmarks it. Returns a new value rather than changing metadata.
+        m = self.metadata
         if is_rejection:
-            m = self.metadata
-            if not m: m = { }
+            m = dict(m or { })
             m["rejected"] = True
-            self.metadata = m
         elif self.was_rejected():
-            m = self.metadata
+            m = dict(m)
             del m["rejected"]
-            self.metadata = m
+        return m
+
+    def _change_state(self, user, new_state, events=None):
+        # Performs change_state within a transaction, raising StateConflict
+        # if the task was changed concurrently. If events is a list, the
+        # TaskEvents are appended to it for the caller to save rather than
+        # saved here.
+
+        if self.state == new_state: return
+
+        is_rejection = self.check_state_change(user, new_state)
+        old_state = self.state
+        now = timezone.now()
+
+        if new_state == "DELETE":
+            # This is a hard delete of a task. Lock the row (and check it is
+            # still in the state we checked against) before deleting it.
+            if Task.objects.filter(id=self.id, state=old_state).update(modified=now) == 0:
+                raise StateConflict()
+            if events is not None:
+                # the task's events will be gone too
+                events[:] = [e for e in events if e.task_id != self.id]
+            self.delete()
+            return
+
+        m = self.get_metadata_after_state_change(is_rejection)
 
         # make change
+        if Task.objects.filter(id=self.id, state=old_state).update(state=new_state, metadata=m, modified=now) == 0:
+            raise StateConflict()
+        before = copy.copy(self)
         self.state = new_state
-        self.save()
+        self.metadata = m
+        self.modified = now
+        TaskListCount.adjust(TaskListCount.task_delta(before, self))
+
+        # record change (user is None for automatic changes)
+        TaskEvent.record(self, "state", user, from_state=old_state, to_state=new_state, events=events)
 
         # if we're moving to the finished state and this Task is auto_close,
         # immediately close it.
         if new_state == 2 and self.auto_close:
-            self.change_state(None, 3)
+            self._change_state(None, 3, events)
             return
 
         # If a dependent task has auto_finish and all its dependencies
         # are now finished or closed, finish that task too
         if new_state in (2, 3):
-            for t in Task.objects.filter(dependencies=self, auto_finish=True, state__in=(0, 1)):
-                t.check_autofinish(self)
-
-    def check_autofinish(self, triggered_by):
-        # Check that all dependencies are Finished or Closed, and if
-        # so then Finish this Task too.
-        #
-        # TODO: Does this need locking/synchronization?
-        if not self.auto_finish: raise ValueError("Not an auto_finish Task.")
-        if self.state not in (0, 1): raise ValueError("Task is already Finished or Closed.")
-        dep_states = self.dependencies.values_list("state", flat=True)
-        for s in dep_states:
-            if s not in (2, 3):
-                return
-        t.change_state(None, 2)
+            Task.propagate_autofinish([self.id])
+
+    @staticmethod
+    def propagate_autofinish(finished_ids):
+        """Finishes (or, if auto_close, closes) the auto_finish tasks whose
+        dependencies are all now Finished or Closed, given the ids of tasks
+        that just became Finished or Closed, and so on through the tasks
+        that depend on those.
+
+        The dependency graph is walked breadth-first. Each level costs a
+        fixed number of queries regardless of its width: one to find the
+        open auto_finish dependents of the level, one to find which of
+        those still have an unfinished dependency, the bulk UPDATEs, and
+        one bulk INSERT of their TaskEvents. Must be called within the
+        transaction of the change that triggered it. Raises StateConflict
+        if a task changed concurrently."""
+
+        frontier = set(finished_ids)
+        while len(frontier) > 0:
+            # The open auto_finish tasks that depend on the frontier.
+            candidates = dict(
+                (id, (state, auto_close, incoming_id, outgoing_id))
+                for id, state, auto_close, incoming_id, outgoing_id
+                in Task.objects.filter(dependencies__in=frontier, auto_finish=True, state__in=(0, 1))
+                    .values_list("id", "state", "auto_close", "incoming_id", "outgoing_id").distinct())
+            if len(candidates) == 0: break
+
+            # Which of them still have a dependency that isn't finished?
+            blocked = set(Task.dependencies.through.objects
+                .filter(from_task__in=candidates.keys())
+                .exclude(to_task__state__in=(2, 3))
+                .values_list("from_task_id", flat=True))
+            ready = [id for id in candidates if id not in blocked]
+            if len(ready) == 0: break
+
+            # Finish them, or close the auto_close ones.
+            now = timezone.now()
+            with TaskEventBatch() as batch:
+                for new_state, ids in (
+                        (2, [id for id in ready if not candidates[id][1]]),
+                        (3, [id for id in ready if candidates[id][1]])):
+                    if len(ids) == 0: continue
+                    if Task.objects.filter(id__in=ids, state__in=(0, 1)).update(state=new_state, modified=now) != len(ids):
+                        raise StateConflict()
+                    counts = { }
+                    for id in ids:
+                        state, auto_close, incoming_id, outgoing_id = candidates[id]
+                        TaskListCount.task_delta((incoming_id, outgoing_id, state), (incoming_id, outgoing_id, new_state), counts)
+                        for from_state, to_state in [(state, 2)] + ([(2, 3)] if new_state == 3 else []):
+                            batch.events.append(TaskEvent(task_id=id, event_type=TASK_EVENT_TYPES.index("state"),
+                                from_state=from_state, to_state=to_state, incoming_id=incoming_id, outgoing_id=outgoing_id))
+                    TaskListCount.adjust(counts)
+
+            frontier = set(ready)
+
+# Task.get_state_matrix's answers, computed once for every key.
+STATE_MATRIX = dict(
+    (Task.get_state_matrix_key(*args), tuple(Task.compute_state_matrix(*args)))
+    for args in itertools.product(
+        range(len(TASK_STATE_NAMES)), # state
+        (set(), set(["admin"])), # roles on the incoming list
+        (set(), set(["admin"])), # roles on the outgoing list
+        (False, True), # anonymous
+        (False, True))) # rejected
+STATE_MATRIX_VERBS = dict(
+    (key, tuple((t[0], t[1], TASK_STATE_VERBS[t]) for t in transitions))
+    for key, transitions in STATE_MATRIX.items())
+
+class TaskListCount(models.Model):
+    """The number of tasks in each state on a TaskList, kept up to date in
+    the same transaction as every change that creates, moves, or deletes
+    tasks, so that counts don't need to scan Task. incoming counts the
+    tasks assigned to the list; outgoing counts the tasks the list assigned
+    to other lists (self-assigned tasks are only incoming). Changes made
+    around Task's methods (e.g. in the admin) aren't counted; the
+    reconcile_counts command fixes any drift."""
+    tasklist = models.ForeignKey(TaskList, db_index=False, related_name="task_counts")
+    state = models.SmallIntegerField(choices=enumerate(TASK_STATE_NAMES))
+    incoming = models.IntegerField(default=0)
+    outgoing = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [("tasklist", "state")]
+
+    @staticmethod
+    def task_delta(before, after, counts=None):
+        """Adds to counts (a dict from (TaskList id, state, "incoming" or
+        "outgoing") to a change in count) the change from a task being as
+        before to being as after, either of which may be None for a task
+        that is being created or deleted. Each may be a Task or, for code
+        that updates tasks without loading them, an (incoming id, outgoing
+        id, state) tuple. Returns counts."""
+        if counts is None: counts = { }
+        for t, sign in ((before, -1), (after, 1)):
+            if t is None: continue
+            incoming_id, outgoing_id, state = t if isinstance(t, tuple) else (t.incoming_id, t.outgoing_id, t.state)
+            key = (incoming_id, state, "incoming")
+            counts[key] = counts.get(key, 0) + sign
+            if outgoing_id is not None and outgoing_id != incoming_id:
+                key = (outgoing_id, state, "outgoing")
+                counts[key] = counts.get(key, 0) + sign
+        return counts
+
+    @staticmethod
+    def adjust(counts):
+        """Applies the changes in counts (as from task_delta)."""
+        for (tasklist_id, state, which_way), delta in sorted(counts.items()):
+            if delta == 0: continue
+            rows = TaskListCount.objects.filter(tasklist=tasklist_id, state=state)
+            if rows.update(**{ which_way: F(which_way) + delta }): continue
+            try:
+                with transaction.atomic():
+                    TaskListCount.objects.create(tasklist_id=tasklist_id, state=state, **{ which_way: delta })
+            except IntegrityError:
+                # created concurrently
+                rows.update(**{ which_way: F(which_way) + delta })
+
+    @staticmethod
+    def get_counts(tasklists, which_way):
+        """Returns a dict from state to the number of tasks incoming to or
+        outgoing from the given TaskLists."""
+        ret = { }
+        for state, count in TaskListCount.objects.filter(tasklist__in=tasklists).values_list("state", which_way):
+            ret[state] = ret.get(state, 0) + count
+        return ret
+
+    @staticmethod
+    def reconcile():
+        """Recomputes all counts from the tasks. Returns a list of
+        (TaskList id, state, "incoming" or "outgoing", stored count,
+        actual count) for each count that was wrong. Run in a transaction."""
+        actual = { }
+        for tasklist_id, state, count in Task.objects.values_list("incoming", "state").annotate(count=Count("id")).order_by():
+            actual[(tasklist_id, state, "incoming")] = count
+        for tasklist_id, state, count in Task.objects.exclude(outgoing=None).exclude(outgoing=F("incoming")).values_list("outgoing", "state").annotate(count=Count("id")).order_by():
+            actual[(tasklist_id, state, "outgoing")] = count
+
+        stored = { }
+        for tasklist_id, state, incoming, outgoing in TaskListCount.objects.values_list("tasklist", "state", "incoming", "outgoing"):
+            stored[(tasklist_id, state, "incoming")] = incoming
+            stored[(tasklist_id, state, "outgoing")] = outgoing
+
+        drift = []
+        for key in sorted(set(actual) | set(stored)):
+            if actual.get(key, 0) != stored.get(key, 0):
+                drift.append(key + (stored.get(key, 0), actual.get(key, 0)))
+        TaskListCount.adjust(dict((d[:3], d[4] - d[3]) for d in drift))
+        return drift
+
+    @staticmethod
+    def on_task_deleted(sender, instance, **kwargs):
+        TaskListCount.adjust(TaskListCount.task_delta(instance, None))
+
+class TaskListGeneration(models.Model):
+    """A number that is incremented whenever a TaskList changes in a way
+    that affects cached values derived from it (see caching.py). It is kept
+    in the database rather than in the cache so that a change made by any
+    server process invalidates the values cached by every other. tasklist
+    isn't a ForeignKey because the generation is also bumped when the list
+    is deleted, and it is kept afterwards in case the id is reused."""
+    tasklist_id = models.IntegerField(unique=True)
+    generation = models.IntegerField(default=0)
+
+    @staticmethod
+    def get(tasklist_ids):
+        """Returns a dict from each TaskList id to its generation."""
+        tasklist_ids = set(tasklist_ids)
+        ret = dict((id, 0) for id in tasklist_ids)
+        if len(tasklist_ids) > 0:
+            ret.update(TaskListGeneration.objects.filter(tasklist_id__in=tasklist_ids).values_list("tasklist_id", "generation"))
+        return ret
+
+    @staticmethod
+    def bump(tasklist_ids):
+        """Increments the generations of the given TaskLists."""
+        tasklist_ids = set(tasklist_ids)
+        if len(tasklist_ids) == 0: return
+        rows = TaskListGeneration.objects.filter(tasklist_id__in=tasklist_ids)
+        if rows.update(generation=F("generation") + 1) == len(tasklist_ids): return
+        for id in sorted(tasklist_ids - set(rows.values_list("tasklist_id", flat=True))):
+            try:
+                with transaction.atomic():
+                    TaskListGeneration.objects.create(tasklist_id=id, generation=1)
+            except IntegrityError:
+                # created concurrently
+                TaskListGeneration.objects.filter(tasklist_id=id).update(generation=F("generation") + 1)
+
+class StateConflict(Exception):
+    """Raised when a Task's state was changed concurrently."""
+    pass
+
+class TaskDependencyClosure(models.Model):
+    """The transitive closure of Task.dependencies: a row for each pair of
+    tasks where task depends on blocker, directly or indirectly. It is kept
+    up to date by signal handlers as dependencies are added and removed and
+    as tasks are deleted, and the handlers reject any dependency that would
+    create a cycle."""
+    task = models.ForeignKey(Task, db_index=False, related_name="closure_blockers")
+    blocker = models.ForeignKey(Task, db_index=False, related_name="closure_dependents")
+
+    class Meta:
+        unique_together = [("task", "blocker")]
+        index_together = [("blocker", "task")]
+
+    @staticmethod
+    def dependents_of(task_ids):
+        """The ids of all tasks that depend on any of the given tasks."""
+        return set(TaskDependencyClosure.objects.filter(blocker__in=task_ids).values_list("task_id", flat=True))
+
+    @staticmethod
+    def check_new_dependencies(edges):
+        """Raises ValueError if adding the (task id, dependency id) edges
+        would create a cycle."""
+        for task_id, dep_id in edges:
+            if task_id == dep_id:
+                raise ValueError("A task cannot depend on itself.")
+        closure = TaskDependencyClosure.objects.filter(
+            task__in=[dep_id for task_id, dep_id in edges],
+            blocker__in=[task_id for task_id, dep_id in edges])
+        existing = set(closure.values_list("task_id", "blocker_id"))
+        for task_id, dep_id in edges:
+            if (dep_id, task_id) in existing:
+                raise ValueError("That dependency would create a cycle.")
+
+    @staticmethod
+    def add_dependencies(edges):
+        """Adds the closure rows implied by new (task id, dependency id) edges:
+        the task and everything that depends on it now depend on the
+        dependency and everything it depends on."""
+        for task_id, dep_id in edges:
+            dependents = TaskDependencyClosure.dependents_of([task_id]) | set([task_id])
+            blockers = set(TaskDependencyClosure.objects.filter(task=dep_id).values_list("blocker_id", flat=True)) | set([dep_id])
+            existing = set(TaskDependencyClosure.objects.filter(task__in=dependents, blocker__in=blockers).values_list("task_id", "blocker_id"))
+            TaskDependencyClosure.objects.bulk_create([
+                TaskDependencyClosure(task_id=t, blocker_id=b)
+                for t in dependents for b in blockers
+                if (t, b) not in existing])
+
+    @staticmethod
+    def rebuild(task_ids=None):
+        """Recomputes the closure rows of the given tasks and of everything
+        that depends on them, after dependencies were removed, or of all
+        tasks if task_ids is None."""
+        edges = Task.dependencies.through.objects.all()
+        if task_ids is None:
+            TaskDependencyClosure.objects.all().delete()
+            affected = set(edges.values_list("from_task_id", flat=True))
+        else:
+            affected = set(task_ids) | TaskDependencyClosure.dependents_of(task_ids)
+            edges = edges.filter(from_task__in=affected)
 
+        # The direct dependencies of the affected tasks, and the (unaffected,
+        # so still correct) closures of those that aren't themselves affected.
+        deps = { }
+        for task_id, dep_id in edges.values_list("from_task_id", "to_task_id"):
+            deps.setdefault(task_id, set()).add(dep_id)
+        outside = set(d for ds in deps.values() for d in ds) - affected
+        blockers = dict((id, set([id])) for id in outside)
+        if task_ids is not None: # otherwise outside tasks have no dependencies
+            for task_id, blocker_id in TaskDependencyClosure.objects.filter(task__in=outside).values_list("task_id", "blocker_id"):
+                blockers[task_id].add(blocker_id)
+
+        # Compute the affected tasks' closures, dependencies first.
+        closure = { }
+        def compute(task_id):
+            # Iterative depth-first search to avoid deep recursion.
+            stack = [task_id]
+            visiting = set()
+            while stack:
+                t = stack[-1]
+                if t in closure:
+                    stack.pop()
+                    continue
+                pending = [d for d in deps.get(t, []) if d in affected and d not in closure]
+                if pending:
+                    if t in visiting:
+                        # only possible if cycles were stored before
+                        # they were checked for
+                        raise ValueError("Task %d is in a dependency cycle." % t)
+                    visiting.add(t)
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                closure[t] = set()
+                for d in deps.get(t, []):
+                    closure[t].add(d)
+                    closure[t] |= closure[d] if d in affected else blockers[d]
+        for task_id in affected:
+            compute(task_id)
+
+        if task_ids is not None:
+            TaskDependencyClosure.objects.filter(task__in=affected).delete()
+        TaskDependencyClosure.objects.bulk_create([
+            TaskDependencyClosure(task_id=t, blocker_id=b)
+            for t in closure for b in closure[t]], batch_size=500)
+
+    # Signal handlers.
+
+    @staticmethod
+    def on_dependencies_changed(sender, instance, action, reverse, pk_set, **kwargs):
+        if not reverse:
+            # instance depends on the tasks in pk_set
+            edges = [(instance.id, id) for id in (pk_set or [])]
+        else:
+            # the tasks in pk_set depend on instance
+            edges = [(id, instance.id) for id in (pk_set or [])]
+
+        if action == "pre_add":
+            TaskDependencyClosure.check_new_dependencies(edges)
+        elif action == "post_add":
+            TaskDependencyClosure.add_dependencies(edges)
+        elif action == "post_remove":
+            TaskDependencyClosure.rebuild([task_id for task_id, dep_id in edges])
+        elif action == "pre_clear":
+            # Remember which tasks lose dependencies.
+            if not reverse:
+                instance._closure_cleared = [instance.id]
+            else:
+                instance._closure_cleared = list(instance.dependents.values_list("id", flat=True))
+        elif action == "post_clear":
+            TaskDependencyClosure.rebuild(instance._closure_cleared)
+
+    @staticmethod
+    def on_task_pre_delete(sender, instance, **kwargs):
+        # Tasks that depended on this task through others need their closures rebuilt.
+        instance._closure_dependents = TaskDependencyClosure.dependents_of([instance.id])
+
+    @staticmethod
+    def on_task_post_delete(sender, instance, **kwargs):
+        if instance._closure_dependents:
+            TaskDependencyClosure.rebuild(instance._closure_dependents)
 
 class TaskEvent(models.Model):
+    """An entry in the append-only history of a Task. What happened is kept
+    in typed columns; event_data holds only what's particular to an event
+    (e.g. the task a dependency was created for), and is usually null. The
+    lists are the task's lists at the time of the event."""
     created = models.DateTimeField(auto_now_add=True, db_index=True)
-    task = models.ForeignKey(Task, db_index=True, related_name="events")
-    event_data = JSONField()
+    task = models.ForeignKey(Task, db_index=False, related_name="events")
+    event_type = models.SmallIntegerField(choices=enumerate(TASK_EVENT_TYPES))
+    user = models.ForeignKey(User, blank=True, null=True, db_index=False, related_name="+", on_delete=models.SET_NULL, help_text="Who made the change, or null for anonymous users and automatic changes.")
+    from_state = models.SmallIntegerField(blank=True, null=True, choices=enumerate(TASK_STATE_NAMES))
+    to_state = models.SmallIntegerField(blank=True, null=True, choices=enumerate(TASK_STATE_NAMES))
+    incoming = models.ForeignKey(TaskList, blank=True, null=True, db_index=False, related_name="+", on_delete=models.SET_NULL)
+    outgoing = models.ForeignKey(TaskList, blank=True, null=True, db_index=False, related_name="+", on_delete=models.SET_NULL)
+    event_data = JSONField(blank=True, null=True)
+
+    class Meta:
+        index_together = [
+            # a task's history
+            ("task", "created"),
+        ]
 
     def __str__(self):
-        return str(self.event_data)
+        ret = TASK_EVENT_TYPES[self.event_type]
+        if self.from_state is not None: ret += " %s => %s" % (TASK_STATE_NAMES[self.from_state], TASK_STATE_NAMES[self.to_state])
+        if self.event_data: ret += " " + str(self.event_data)
+        return ret
+
+    @staticmethod
+    def record(task, event_type, user=None, from_state=None, to_state=None, events=None, **extras):
+        """Records an event of the given type (a TASK_EVENT_TYPES name) for
+        task, saving it immediately or, if events is a list (such as a
+        TaskEventBatch's), appending it to be saved with the others. Any
+        other keyword arguments are stored in event_data."""
+        e = TaskEvent()
+        e.task = task
+        e.event_type = TASK_EVENT_TYPES.index(event_type)
+        e.user = user if user and user.is_authenticated() else None
+        e.from_state = from_state
+        e.to_state = to_state
+        e.incoming_id = task.incoming_id
+        e.outgoing_id = task.outgoing_id
+        e.event_data = extras or None
+        if events is None:
+            e.save()
+        else:
+            events.append(e)
+        return e
+
+class TaskEventBatch(object):
+    """Collects TaskEvents so that they are written in groups, with one
+    bulk INSERT per group, rather than one INSERT each. Use it as a context
+    manager around code that passes its events list to the methods that
+    take one. Call flush_if_full between operations to write a group once
+    it reaches size events. The rest are written when the block exits
+    without an exception (if it raises, the events are discarded with the
+    transaction that should be rolling back).
+
+    bulk_create doesn't send post_save, so the batch notifies the push
+    server itself."""
+
+    def __init__(self, size=500):
+        self.size = size
+        self.events = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def flush_if_full(self):
+        if len(self.events) >= self.size:
+            self.flush()
+
+    def flush(self):
+        events = list(self.events)
+        del self.events[:] # callers may hold on to the list
+        if len(events) == 0: return
+        TaskEvent.objects.bulk_create(events)
+        push.publish(set(e.incoming_id for e in events) | set(e.outgoing_id for e in events))
+
+class TaskEventSummary(models.Model):
+    """A roll-up of a Task's TaskEvents that were deleted by the
+    compact_events command, so that old history takes one row per task."""
+    task = models.OneToOneField(Task, related_name="event_summary")
+    num_events = models.IntegerField(default=0)
+    num_state_changes = models.IntegerField(default=0)
+    first_event = models.DateTimeField()
+    last_event = models.DateTimeField()
+    last_state = models.SmallIntegerField(blank=True, null=True, choices=enumerate(TASK_STATE_NAMES), help_text="The state the last summarized state change moved the task to.")
+
+    def add(self, created, event_type, to_state):
+        # Rolls an event into the summary. Events must be added in order.
+        if self.num_events == 0 or created < self.first_event: self.first_event = created
+        self.last_event = created
+        self.num_events += 1
+        if event_type == TASK_EVENT_TYPES.index("state"):
+            self.num_state_changes += 1
+            self.last_state = to_state
+
+class DeletedTask(models.Model):
+    """A record that a Task was deleted, so that clients polling a task list
+    for changes learn of the deletion. (A deleted Task's TaskEvents are
+    deleted with it.)"""
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    task_id = models.IntegerField()
+    incoming = models.ForeignKey(TaskList, db_index=False, related_name="+")
+    outgoing = models.ForeignKey(TaskList, blank=True, null=True, db_index=False, related_name="+")
+    creator = models.ForeignKey(User, blank=True, null=True, db_index=False, related_name="+")
+
+    class Meta:
+        index_together = [
+            ("incoming", "created"),
+            ("outgoing", "created"),
+        ]
+
+    @staticmethod
+    def on_task_deleted(sender, instance, **kwargs):
+        DeletedTask.objects.create(
+            task_id=instance.id,
+            incoming_id=instance.incoming_id,
+            outgoing_id=instance.outgoing_id,
+            creator_id=instance.creator_id)
 
 class UserHandle(models.Model):
     """A model just for searching for users by handle. Updated each time a user
@@ -404,5 +1259,39 @@ class UserHandle(models.Model):
         for h in handles - old_handles:
             UserHandle.objects.create(user=user, handle=h)
 
+        # Update this process's search index.
+        from cotaskme.search import handle_index
+        handle_index.update_user(user.id, handles - old_handles, old_handles - handles)
+
 from django.contrib.auth.signals import user_logged_in
 user_logged_in.connect(UserHandle.on_user_login)
+
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from cotaskme import caching
+post_save.connect(caching.tasklist_changed, sender=TaskList)
+pre_delete.connect(caching.tasklist_changed, sender=TaskList)
+post_delete.connect(caching.tasklist_changed, sender=TaskList)
+post_delete.connect(DeletedTask.on_task_deleted, sender=Task)
+post_delete.connect(TaskListCount.on_task_deleted, sender=Task)
+m2m_changed.connect(TaskDependencyClosure.on_dependencies_changed, sender=Task.dependencies.through)
+pre_delete.connect(TaskDependencyClosure.on_task_pre_delete, sender=Task)
+post_delete.connect(TaskDependencyClosure.on_task_post_delete, sender=Task)
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    # Write-ahead logging lets requests read while another process writes,
+    # and with it fsyncing only at checkpoints is still safe against
+    # corruption. (The journal mode is stored in the database file, but
+    # setting it again is cheap.)
+    if connection.vendor == "sqlite":
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+
+from django.db.backends.signals import connection_created
+connection_created.connect(configure_sqlite_connection)
+
+from cotaskme import push
+post_save.connect(push.task_event_saved, sender=TaskEvent)
+post_save.connect(push.task_deleted, sender=DeletedTask)
+for through in (TaskList.owners.through, TaskList.posters.through, TaskList.observers.through):
+    m2m_changed.connect(caching.tasklist_members_changed, sender=through)
@@ -0,0 +1,142 @@
+"""Opt-in request profiling.
+
+When settings.COTASKME_PROFILING is True, ProfilingMiddleware records for
+each request the view, the wall time, the number and total time of SQL
+queries, the time spent rendering templates, and the SQL statements that
+were repeated (after replacing their literal values), which usually means
+an N+1 query. Each request gets a Server-Timing header and a JSON log line
+on the cotaskme.profiling logger, and its timings are added to a rolling
+window per view. The percentiles over the window are served to staff
+users at /_profiling. The window is per process.
+
+When the setting is off, the middleware raises MiddlewareNotUsed, so
+Django drops it and nothing is instrumented."""
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponseForbidden
+
+from cotaskme.utils import json_response
+
+import collections, json, logging, re, threading, time
+
+logger = logging.getLogger("cotaskme.profiling")
+
+WINDOW_SIZE = 1000 # most recent requests kept per view
+REPEATED_QUERY_THRESHOLD = 3 # report statements run at least this many times in a request
+
+_local = threading.local()
+_lock = threading.Lock()
+_window = { } # view name => deque of (time, wall ms, query count, query ms, template ms)
+
+class ProfilingMiddleware(object):
+    def __init__(self):
+        if not getattr(settings, "COTASKME_PROFILING", False):
+            raise MiddlewareNotUsed()
+        instrument_templates()
+
+    def process_request(self, request):
+        # Record queries even if DEBUG is off.
+        request._profiling = {
+            "start": time.time(),
+            "first_query": len(connection.queries),
+            "debug_cursor": connection.use_debug_cursor,
+            "view": None,
+        }
+        connection.use_debug_cursor = True
+        _local.template_time = 0.0
+        _local.template_depth = 0
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, "_profiling"):
+            request._profiling["view"] = view_func.__module__ + "." + view_func.__name__
+
+    def process_response(self, request, response):
+        p = getattr(request, "_profiling", None)
+        if p is None: return response # e.g. an earlier middleware responded
+
+        wall = (time.time() - p["start"]) * 1000
+        queries = connection.queries[p["first_query"]:]
+        query_time = sum(float(q["time"]) for q in queries) * 1000
+        template_time = _local.template_time * 1000
+        view = p["view"] or request.path
+
+        # Stop recording queries, unless DEBUG is recording them anyway.
+        connection.use_debug_cursor = p["debug_cursor"]
+        if not settings.DEBUG:
+            connection.queries = []
+
+        response["Server-Timing"] = "total;dur=%.1f, db;dur=%.1f;desc=\"%d queries\", tpl;dur=%.1f" % (
+            wall, query_time, len(queries), template_time)
+
+        logger.info(json.dumps({
+            "view": view,
+            "method": request.method,
+            "status": response.status_code,
+            "wall_ms": round(wall, 1),
+            "queries": len(queries),
+            "query_ms": round(query_time, 1),
+            "template_ms": round(template_time, 1),
+            "repeated_queries": get_repeated_queries(queries),
+        }, sort_keys=True))
+
+        with _lock:
+            if view not in _window:
+                _window[view] = collections.deque(maxlen=WINDOW_SIZE)
+            _window[view].append((time.time(), wall, len(queries), query_time, template_time))
+
+        return response
+
+def get_repeated_queries(queries):
+    # Returns [[count, statement], ...] for the statements that were run at
+    # least REPEATED_QUERY_THRESHOLD times, differing only in their values.
+    counts = collections.Counter(normalize_sql(q["sql"]) for q in queries)
+    return [[n, sql] for sql, n in counts.most_common() if n >= REPEATED_QUERY_THRESHOLD]
+
+def normalize_sql(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql) # string literals
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql) # numbers
+    sql = re.sub(r"\?(, \?)+", "?, ...", sql) # IN lists of any length
+    return sql
+
+def instrument_templates():
+    # Wrap Template._render (as Django's test framework does) to time
+    # rendering. Nested renders (includes, extends) are only counted once.
+    from django.template.base import Template
+    if getattr(Template._render, "_profiled", False): return
+    original = Template._render
+    def _render(self, context):
+        depth = getattr(_local, "template_depth", 0)
+        _local.template_depth = depth + 1
+        start = time.time()
+        try:
+            return original(self, context)
+        finally:
+            _local.template_depth = depth
+            if depth == 0:
+                _local.template_time = getattr(_local, "template_time", 0.0) + (time.time() - start)
+    _render._profiled = True
+    Template._render = _render
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def get_report():
+    """Returns the percentiles of each view's timings over its window."""
+    with _lock:
+        windows = dict((view, list(samples)) for view, samples in _window.items())
+    ret = { }
+    for view, samples in sorted(windows.items()):
+        ret[view] = { "requests": len(samples), "since": min(s[0] for s in samples) }
+        for i, name in ((1, "wall_ms"), (2, "queries"), (3, "query_ms"), (4, "template_ms")):
+            values = [s[i] for s in samples]
+            ret[view][name] = dict(("p%d" % p, round(percentile(values, p), 1)) for p in (50, 90, 99))
+    return ret
+
+@json_response
+def report_view(request):
+    if not request.user.is_authenticated() or not request.user.is_staff:
+        return HttpResponseForbidden()
+    return get_report()
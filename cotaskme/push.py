@@ -0,0 +1,71 @@
+"""Server push of task list changes.
+
+The web server processes publish the ids of TaskLists whose tasks changed
+as datagrams on a Unix socket (settings.COTASKME_PUSH_SOCKET). The push
+server (./manage.py runpushserver) receives them and fans them out over
+server-sent event streams to the browsers viewing those lists, which then
+fetch the changes from the tasklist_changes view. The push server is a
+single-threaded event loop, so it holds thousands of idle connections
+without tying up a worker process per connection.
+
+Changes are published after they are committed, so that the changes view
+a browser fetches on being notified sees them: code that changes tasks
+enters deferred() before transaction.atomic().
+
+If COTASKME_PUSH_SOCKET is not set, publishing does nothing."""
+
+from django.conf import settings
+
+from contextlib import contextmanager
+import socket, threading
+
+_socket = None
+_deferred = threading.local()
+
+def publish(tasklist_ids):
+    """Notifies subscribers of the given TaskLists that they changed. This
+    never blocks and silently does nothing if the push server isn't running."""
+    global _socket
+    path = getattr(settings, "COTASKME_PUSH_SOCKET", None)
+    if not path: return
+    tasklist_ids = set(id for id in tasklist_ids if id is not None)
+    if len(tasklist_ids) == 0: return
+    pending = getattr(_deferred, "pending", None)
+    if pending is not None:
+        pending |= tasklist_ids
+        return
+    if _socket is None:
+        _socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        _socket.setblocking(False)
+    try:
+        _socket.sendto(",".join(str(id) for id in sorted(tasklist_ids)).encode("ascii"), path)
+    except socket.error:
+        # The server isn't running or is too far behind. Clients also poll,
+        # so they will pick up the change anyway.
+        pass
+
+@contextmanager
+def deferred():
+    """Holds what is published within the block and publishes it when the
+    block exits, unless it raised (and so its transaction was rolled back).
+    Nested blocks are published with the outermost one."""
+    if getattr(_deferred, "pending", None) is not None:
+        yield
+        return
+    _deferred.pending = pending = set()
+    try:
+        yield
+    finally:
+        _deferred.pending = None
+    publish(pending)
+
+# Signal handlers.
+
+def task_event_saved(sender, instance, created, **kwargs):
+    if created:
+        publish([instance.incoming_id, instance.outgoing_id])
+
+def task_deleted(sender, instance, created, **kwargs):
+    # a DeletedTask was recorded
+    if created:
+        publish([instance.incoming_id, instance.outgoing_id])
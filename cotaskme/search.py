@@ -0,0 +1,61 @@
+import bisect, heapq, threading, time
+
+class HandlePrefixIndex(object):
+    """An in-process index of UserHandle.handle for prefix (typeahead) searches.
+
+    The handles are held in a sorted array, so a prefix search is a binary
+    search plus a scan over just the matching handles. The index is loaded
+    from the database on first use, updated incrementally as users log in
+    (see UserHandle.on_user_login), and reloaded after max_age seconds so
+    that it picks up logins handled by other processes."""
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.keys = None # sorted list of (lowercased handle, handle, user id)
+        self.loaded_at = None
+
+    def _load(self):
+        from cotaskme.models import UserHandle
+        keys = sorted((h.lower(), h, u) for h, u in UserHandle.objects.values_list("handle", "user_id"))
+        self.keys = keys
+        self.loaded_at = time.time()
+
+    def _ensure_loaded(self):
+        if self.keys is None or time.time() - self.loaded_at > self.max_age:
+            self._load()
+
+    def invalidate(self):
+        with self.lock:
+            self.keys = None
+
+    def update_user(self, user_id, added, removed):
+        """Adds and removes handles of a user, keeping the index sorted."""
+        with self.lock:
+            if self.keys is None: return # will be loaded fresh on next use
+            for h in removed:
+                key = (h.lower(), h, user_id)
+                i = bisect.bisect_left(self.keys, key)
+                if i < len(self.keys) and self.keys[i] == key:
+                    del self.keys[i]
+            for h in added:
+                key = (h.lower(), h, user_id)
+                i = bisect.bisect_left(self.keys, key)
+                if i == len(self.keys) or self.keys[i] != key:
+                    self.keys.insert(i, key)
+
+    def search(self, prefix, limit):
+        """Returns up to limit (handle, user id) pairs for handles that start
+        with prefix (case-insensitively), best matches first: an exact match,
+        then shorter handles, then alphabetically."""
+        prefix = prefix.lower()
+        if prefix == "": return []
+        with self.lock:
+            self._ensure_loaded()
+            lo = bisect.bisect_left(self.keys, (prefix,))
+            hi = bisect.bisect_left(self.keys, (prefix + u"\uffff",))
+            matches = self.keys[lo:hi]
+        best = heapq.nsmallest(limit, matches, key=lambda k : (k[0] != prefix, len(k[0]), k[0]))
+        return [(handle, user_id) for key, handle, user_id in best]
+
+handle_index = HandlePrefixIndex()
@@ -9,7 +9,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 """
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
-import os
+import os, tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -38,6 +38,7 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'cotaskme.profiling.ProfilingMiddleware', # only if COTASKME_PROFILING is set
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -65,19 +66,61 @@ TEMPLATE_DIRS = (
     os.path.join(BASE_DIR, "templates"),
     )
 
+# Compile each template once per process rather than on every render
+# (except when debugging, so that template edits show up immediately).
+if 'TEMPLATE_LOADERS' not in dir() and not DEBUG:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', (
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        )),
+    )
+
 WSGI_APPLICATION = 'cotaskme.wsgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
 
+# Connections are kept open for CONN_MAX_AGE seconds rather than opened for
+# each request. SQLite waits up to 'timeout' seconds for another process's
+# write lock instead of failing at once. (models.py also turns on
+# write-ahead logging for each new SQLite connection.) The test database
+# is a file rather than in memory so that tests can use several threads.
+# It goes in the temporary directory to stay out of the working tree.
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db/database.sqlite3'),
+        'TEST_NAME': os.path.join(tempfile.gettempdir(), 'cotaskme-test.sqlite3'),
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+# Rendered task rows and list titles are cached (see cotaskme/caching.py).
+# The default cache is per-process, which is correct because invalidation
+# goes through the database; settings_local.py can set CACHES to a cache
+# shared by all of the server processes so that they share cached values.
+
+if 'CACHES' not in dir():
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Profiling
+# See cotaskme/profiling.py. settings_local.py can set this to True.
+
+if 'COTASKME_PROFILING' not in dir():
+    COTASKME_PROFILING = False
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -0,0 +1,43 @@
+SECRET_KEY="n34kzyptqu#b9x4t9a07*egjc1iygv5=g+^2s6c3o1j2slbnb4"
+
+# in production replace the SECRET_KEY by generating a new one like so:
+# import random
+# "".join([random.choice("abcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*(-_=+)") for i in range(50)])
+
+DEBUG = True
+
+# login providers
+#################
+# SOCIAL_AUTH_TWITTER_KEY = "..."
+# SOCIAL_AUTH_TWITTER_SECRET = "..."
+
+# cache
+#######
+# By default each server process has its own in-memory cache. To share
+# one cache among all of the FastCGI processes without running another
+# service, use a file-based cache:
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#         'LOCATION': '/tmp/cotaskme-cache',
+#     }
+# }
+# or, if memcached is running on a Unix socket:
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': 'unix:/tmp/memcached.sock',
+
+# push server
+#############
+# To push task list changes to browsers as they happen, run
+# ./manage.py runpushserver and route COTASKME_PUSH_URL to it
+# (see deployment/nginx.conf).
+# COTASKME_PUSH_SOCKET = "/tmp/cotaskme-push.sock"
+# COTASKME_PUSH_URL = "/_push"
+
+# profiling
+###########
+# To time each request's view, queries, and template rendering, and to
+# log the queries it repeats, turn this on. Responses get a Server-Timing
+# header, each request is logged as JSON to the cotaskme.profiling logger,
+# and staff users can see percentiles per view at /_profiling.
+# COTASKME_PROFILING = True
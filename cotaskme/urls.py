@@ -1,7 +1,5 @@
 from django.conf.urls import patterns, include, url
-
-from django.contrib import admin
-admin.autodiscover()
+from django.core.urlresolvers import RegexURLResolver
 
 urlpatterns = patterns('',
     url(r'^$', 'cotaskme.views.home', name='home'),
@@ -11,15 +9,24 @@ urlpatterns = patterns('',
 
     url(r'^tasks()(?:/(outgoing|incoming))?$', 'cotaskme.views.tasklist', name='tasklist'),
     url(r'^t/([^/]+)(?:/(outgoing|incoming))?$', 'cotaskme.views.tasklist', name='tasklist'),
+    url(r'^tasks()/changes$', 'cotaskme.views.tasklist_changes', name='tasklist_changes'),
+    url(r'^t/([^/]+)/changes$', 'cotaskme.views.tasklist_changes', name='tasklist_changes'),
     url(r'^_action$', 'cotaskme.views.tasklist_action', name='tasklist_action'),
     url(r'^_post$', 'cotaskme.views.tasklist_post', name='tasklist_post'),
+    url(r'^_bulk_post$', 'cotaskme.views.tasklist_bulk_post', name='tasklist_bulk_post'),
+    url(r'^_bulk_action$', 'cotaskme.views.tasklist_bulk_action', name='tasklist_bulk_action'),
+    url(r'^_tasks$', 'cotaskme.views.tasklist_page', name='tasklist_page'),
     url(r'^_claim$', 'cotaskme.views.new_user_claim_tasks', name='new_user_claim_tasks'),
 
+    url(r'^_profiling$', 'cotaskme.profiling.report_view', name='profiling_report'),
+
     url('', include('social.apps.django_app.urls', namespace='social')),
 
     url('profile$', 'cotaskme.views.profile_view'),
     url('accounts/login/?$', 'cotaskme.views.login_view'),
     url('accounts/logout/?$', 'cotaskme.views.logout_view'),
 
-    url(r'^admin/', include(admin.site.urls)),
+    # include() would import the admin now. A resolver given the module's
+    # name imports it on first use (see admin_urls.py).
+    RegexURLResolver(r'^admin/', 'cotaskme.admin_urls', app_name='admin', namespace='admin'),
 )
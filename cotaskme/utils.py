@@ -2,10 +2,11 @@ from django.http import HttpResponse
 from django import forms
 from django.conf import settings
 
-import json
+import functools, json
 
 def json_response(f):
 	"""Turns dict output into a JSON response."""
+	@functools.wraps(f)
 	def g(*args, **kwargs):
 		try:
 			ret = f(*args, **kwargs)
@@ -12,3 +12,19 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cotaskme.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# Django loads the middleware and the URLconf (and with it the views and
+# the models), indexes the URLconf for reversing, finds the social login
+# backends, and compiles templates on the first request that needs them. Do it now instead, so that a server that loads the
+# application before forking (gunicorn's preload_app, or runfcgi in
+# prefork mode) does it once, and its workers answer their first request
+# as fast as any other. The admin, which few requests use, is still
+# loaded on first use (see admin_urls.py).
+from django.core.urlresolvers import get_resolver
+from django.template.loader import get_template
+from cotaskme.views import get_login_backends
+application.load_middleware()
+get_resolver(None).reverse_dict
+get_login_backends()
+for template in ("index.html", "tasklist.html"):
+    get_template(template)
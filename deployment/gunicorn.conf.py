@@ -0,0 +1,38 @@
+# Gunicorn settings for serving cotaskme.wsgi (see deployment/wsgi,
+# which reads wsgi.conf and passes its settings here in the environment).
+
+import os
+
+bind = "127.0.0.1:%s" % os.environ.get("PORT", "3011")
+
+# Worker processes, each handling THREADS requests at a time. With more
+# than one thread, requests that wait on the database or on slow clients
+# don't hold up a whole process. (Threads need the "futures" package on
+# Python 2, which pip-requirements.txt installs there.)
+workers = int(os.environ.get("WORKERS", "4"))
+threads = int(os.environ.get("THREADS", "1"))
+
+# Recycle each worker after this many requests (0 to never), spread out
+# so that the workers don't all restart at once.
+max_requests = int(os.environ.get("MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+timeout = 25
+graceful_timeout = 25
+keepalive = 5
+
+# Load the application in the master process before forking, so that
+# workers share its memory and start without importing Django again.
+# Code changes then need a new master; deployment/wsgi graceful does that.
+preload_app = True
+
+pidfile = os.environ.get("PIDFILE", "/tmp/gunicorn-cotaskme.pid")
+accesslog = os.path.expanduser("~/logs/django_access_log")
+errorlog = os.path.expanduser("~/logs/django_error_log")
+
+def post_fork(server, worker):
+    # Loading the application may have opened database connections
+    # (e.g. at import time), and a forked child must not share them.
+    from django.db import connections
+    for conn in connections.all():
+        conn.close()
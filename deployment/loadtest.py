@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Makes concurrent GET requests to a running site and reports throughput
+# and latency percentiles, to compare serving setups on the same machine.
+# For instance, run it against nginx in front of deployment/fcgi, switch
+# nginx.conf to deployment/wsgi, and run it again:
+#
+#   deployment/loadtest.py --concurrency 16 --requests 2000 \
+#       --cookie sessionid=... http://localhost/t/mylist /tasks
+#
+# Paths after the first URL are on the same site. Each client thread
+# cycles through the URLs. Only the standard library is used, so it runs
+# without the site's virtualenv.
+
+from __future__ import print_function
+
+import optparse, sys, threading, time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+    from urllib.parse import urljoin
+except ImportError: # Python 2
+    from urllib2 import Request, urlopen, HTTPError
+    from urlparse import urljoin
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] url [path ...]")
+    parser.add_option('--concurrency', type="int", default=8, help="Number of requests to make at a time.")
+    parser.add_option('--requests', type="int", default=1000, help="Total number of requests to make.")
+    parser.add_option('--cookie', help="A Cookie header to send, such as a logged-in user's sessionid.")
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("Give a URL.")
+    urls = [args[0]] + [urljoin(args[0], path) for path in args[1:]]
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [options.requests]
+
+    def client():
+        i = 0
+        while True:
+            with lock:
+                if remaining[0] == 0: return
+                remaining[0] -= 1
+            request = Request(urls[i % len(urls)])
+            if options.cookie: request.add_header("Cookie", options.cookie)
+            i += 1
+            start = time.time()
+            try:
+                urlopen(request, timeout=30).read()
+                error = None
+            except HTTPError as e:
+                error = "HTTP %d" % e.code
+            except Exception as e:
+                error = str(e)
+            elapsed = time.time() - start
+            with lock:
+                if error: errors.append(error)
+                else: latencies.append(elapsed * 1000)
+
+    threads = [threading.Thread(target=client) for i in range(options.concurrency)]
+    start = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.time() - start
+
+    print("%d requests in %.1f sec at concurrency %d: %.1f requests/sec" % (options.requests, elapsed, options.concurrency, options.requests / elapsed))
+    if latencies:
+        latencies.sort()
+        print("latency ms: " + "  ".join(
+            "p%d %.1f" % (p, latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))])
+            for p in (50, 90, 99)))
+    if errors:
+        print("%d errors, e.g. %s" % (len(errors), errors[0]))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -116,4 +116,87 @@ function start_login(a_elem) {
   // Okay, redirect to login with the next paramater storing where we want to go after.
   window.location = a_elem.href + "?next=" + encodeURIComponent(next);
   return false; // prevent default link behavior
-}
\ No newline at end of file
+}
+function poll_task_changes(url, view_orientation, cursor, push_url) {
+  // Periodically ask the server for tasks that were created, changed, or
+  // deleted on the task list being viewed, and patch them into the page.
+  // If the server pushes notifications of changes, poll when notified
+  // and otherwise only rarely.
+  var interval = 5000;
+  var timer = null;
+  var in_flight = false, poll_again = false;
+
+  function schedule(delay) {
+    clearTimeout(timer);
+    timer = setTimeout(poll, delay);
+  }
+
+  function poll() {
+    if (in_flight) { poll_again = true; return; }
+    in_flight = true;
+    $.ajax(
+      url,
+      {
+        data: { since: cursor, which_way: view_orientation },
+        method: "GET",
+        success: function(res) {
+          in_flight = false;
+          if (res.status != "ok") return; // stop polling
+          if (res.reload) {
+            // too much changed to patch
+            window.location.reload();
+            return;
+          }
+          cursor = res.cursor;
+          apply_task_changes(res);
+          schedule(poll_again ? 0 : interval);
+          poll_again = false;
+        },
+        error: function() {
+          // try again later
+          in_flight = false;
+          schedule(30000);
+        }
+      });
+  }
+
+  if (push_url && window.EventSource) {
+    interval = 60000;
+    var source = new EventSource(push_url);
+    source.onmessage = function() {
+      schedule(250); // coalesce bursts of notifications
+    };
+  }
+
+  schedule(interval);
+}
+
+function apply_task_changes(res) {
+  // Applying the same change twice has no effect.
+  $.each(res.deleted, function(i, task_id) {
+    var elem = $('#tasklist-item-' + task_id);
+    var container = elem.parent(".tasklist-group");
+    elem.remove();
+    if (container.length && container.find('.tasklist-item').length == 0 && container.find('.tasklist-more').length == 0)
+      container.hide();
+  });
+
+  $.each(res.tasks, function(i, task) {
+    var new_node = $(task.html);
+    var old_node = $('#tasklist-item-' + task.id);
+    var container = $("#tasklist-group-" + task.state);
+    if (old_node.length && old_node.parent()[0] == container[0]) {
+      // the task is still in the same group: just update it in place
+      old_node.replaceWith(new_node);
+    } else {
+      // put the task at the top of its new group
+      var old_container = old_node.parent(".tasklist-group");
+      old_node.remove();
+      if (old_container.length && old_container.find('.tasklist-item').length == 0 && old_container.find('.tasklist-more').length == 0)
+        old_container.hide();
+      new_node.insertAfter(container.find('.tasklist-item-animation-placeholder'));
+      container.show();
+      $('#no_tasks').hide();
+    }
+  });
+}